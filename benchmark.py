@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the pipeline stages on synthetic Google mobility and OxCGRT data.
+
+@author: Anna Davy
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import utils
+import clustering
+
+
+GOOGLE_COLUMNS = ['country_region_code', 'country_region', 'sub_region_1', 'sub_region_2',
+                  'metro_area', 'iso_3166_2_code', 'census_fips_code', 'place_id', 'date']\
+                 + utils.MOBILITY_COLUMNS
+
+STAGES = ['read', 'format_main_data', 'format_stringency', 'group_data', 'clustering', 'write']
+
+# upper bounds of the in-memory size of the mobility frames of DataPreProcessor
+BYTES_PER_ROW = {'source_data': 40, 'data': 48}
+
+# seconds allowed to import the headless entry points, and modules they must not load
+IMPORT_BUDGET = 1.5
+DEFERRED_MODULES = ('tkinter', 'tkcalendar', 'dateparser', 'sklearn', 'threadpoolctl', 'polars')
+
+
+def synthetic_countries(scale):
+    """Returns the (code, name) pairs of int(40 * scale) synthetic countries."""
+
+    return [('C'+str(number).zfill(3), 'Country '+str(number).zfill(3))
+            for number in range(max(1, int(40*scale)))]
+
+
+def generate_mobility(path, scale=1.0, days=365, start=date(2020, 2, 15), seed=0,
+                      sub_regions=5, sub_regions_2=3):
+    """
+    Writes a synthetic Global_Mobility_Report.csv with the Google column layout.
+
+    Every country has a national row, `sub_regions` sub_region_1 rows and
+    `sub_regions_2` sub_region_2 rows per sub_region_1 for each of `days` days,
+    rows being ordered by region and date as in the Google file. About 5% of the
+    percent changes are missing.
+    """
+
+    rng = np.random.default_rng(seed)
+    dates = [str(start+timedelta(days=offset)) for offset in range(days)]
+
+    for position, (code, name) in enumerate(synthetic_countries(scale)):
+
+        regions = [(None, None)]
+        for sub_region in range(sub_regions):
+            regions.append(('Region '+str(sub_region), None))
+            regions += [('Region '+str(sub_region), 'County '+str(county))
+                        for county in range(sub_regions_2)]
+
+        frame = pd.DataFrame([(code, name, sub_region_1, sub_region_2, None,
+                               None if sub_region_1 is None else code+'-'+sub_region_1[-1],
+                               None, 'place_'+code+str(number), day)
+                              for number, (sub_region_1, sub_region_2) in enumerate(regions)
+                              for day in dates], columns=GOOGLE_COLUMNS[:9])
+
+        values = rng.integers(-90, 60, size=(len(frame), len(utils.MOBILITY_COLUMNS)))
+        for column, column_values in zip(utils.MOBILITY_COLUMNS, values.T):
+            frame[column] = pd.array(column_values, dtype='Int16')
+            frame.loc[rng.random(len(frame)) < 0.05, column] = pd.NA
+
+        frame.to_csv(path, mode='w' if position == 0 else 'a', header=position == 0, index=False)
+
+
+def generate_stringency(path, scale=1.0, start=date(2020, 1, 1), days=500, seed=0):
+    """
+    Writes a synthetic OxCGRT timeseries workbook: one row per country with
+    'CountryCode' and 'CountryName' followed by one 'DDMonYYYY' column per day.
+    About 2% of the values are missing.
+    """
+
+    rng = np.random.default_rng(seed)
+    countries = synthetic_countries(scale)
+    headers = [(start+timedelta(days=offset)).strftime('%d%b%Y') for offset in range(days)]
+
+    values = np.round(rng.uniform(0, 100, size=(len(countries), days)), 2)
+    values[rng.random(values.shape) < 0.02] = np.nan
+
+    sheet = pd.concat([pd.DataFrame(countries, columns=['CountryCode', 'CountryName']),
+                       pd.DataFrame(values, columns=headers)], axis=1)
+    sheet.to_excel(path, index=False)
+
+
+def run(data_dir, output_dir, level='country', n_clusters=4, seed=0, engine='pandas'):
+    """
+    Runs every pipeline stage once on the files in `data_dir` under a utils.RunReport
+    with memory tracing, preprocessing with the pandas or the Polars ('polars')
+    engine. Below the country level the 'group_data' stage times the
+    regions.RegionCube window that batch runs use.
+
+    Returns:
+        the wall time and traced peak of each stage and, with the pandas engine, the
+        bytes per row of the full and of the formatted mobility frames of the
+        DataPreProcessor
+    """
+
+    mobility_file = os.path.join(data_dir, 'Global_Mobility_Report.csv')
+    stringency_file = os.path.join(data_dir, 'OxCGRT_timeseries_all.xlsx')
+
+    # the clustering stage measures the fit, not the deferred scikit-learn import
+    clustering.make_model(n_clusters, n_clusters)
+
+    with utils.RunReport(trace_memory=True) as report:
+
+        with report.stage('read'):
+            if engine == 'polars':
+                import lazy
+                data,stringency = utils.DataReader(stringency_file).read()
+                processor = lazy.LazyPreProcessor(mobility_file, stringency, level=level)
+            else:
+                data,stringency = utils.DataReader(mobility_file, stringency_file, streaming=True,
+                                                   level=level).read()
+                processor = utils.DataPreProcessor(data,stringency)
+            first_date, last_date, base_date = processor.get_dates()
+
+        data, date_dict, dict_weeks = processor.format_main_data(first_date, last_date)
+        if engine == 'polars':
+            footprint = {}
+        else:
+            footprint = {name: frame.memory_usage(deep=True).sum()/max(len(frame), 1)
+                         for name, frame in [('source_data', processor.source_data), ('data', data)]}
+        processor.format_stringency(first_date, last_date, date_dict, dict_weeks)
+        if level == 'country':
+            data_final = processor.group_data()
+        else:
+            # sub-national entities are grouped by the pipeline's regions.RegionCube
+            import regions
+            with report.stage('group_data'):
+                data_final = regions.RegionCube.from_processor(processor, level).window(first_date,
+                                                                                        last_date)
+        labels, model = clustering.fit_clusters(clustering.features(data_final), n_clusters, seed)
+        data_final['group'] = labels
+        utils.DataWriter(data_final, output_dir=output_dir, names=['benchmark']).write_to_excel()
+
+    results = {record['stage']: {'seconds': record['wall_seconds'], 'peak_mb': record['traced_peak_mb']}
+               for record in report.stages if record['depth'] == 0}
+
+    return results, footprint
+
+
+def import_times(modules=('main', 'service'), repeat=3):
+    """
+    Imports each module in a fresh interpreter, as a headless run would.
+
+    Returns:
+        for every module the best wall time of `repeat` imports and the
+        DEFERRED_MODULES it loaded
+    """
+
+    code = ('import sys, json, time; start = time.perf_counter(); import {0}; '
+            'print(json.dumps([time.perf_counter() - start, '
+            '[name for name in {1} if name in sys.modules]]))')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = {}
+
+    for module in modules:
+        runs = [json.loads(subprocess.run([sys.executable, '-c', code.format(module, DEFERRED_MODULES)],
+                                          cwd=directory, capture_output=True, text=True,
+                                          check=True).stdout)
+                for _ in range(repeat)]
+        times[module] = {'seconds': min(seconds for seconds, loaded in runs), 'loaded': runs[0][1]}
+
+    return times
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance, time_slack=0.1, memory_slack=16):
+    """
+    Returns the regressions: stages slower than the baseline by more than
+    `time_tolerance` or using more memory than it by more than `memory_tolerance`
+    (both relative). Differences below `time_slack` seconds and `memory_slack` MB
+    are ignored, as small stages are dominated by noise.
+    """
+
+    regressions = []
+
+    for stage, measured in results.items():
+
+        reference = baseline.get(stage)
+        if reference is None:
+            continue
+        if measured['seconds'] > max(reference['seconds']*(1+time_tolerance),
+                                     reference['seconds']+time_slack):
+            regressions.append(stage+': '+format(measured['seconds'], '.3f')+' s, baseline '
+                               +format(reference['seconds'], '.3f')+' s')
+        if measured['peak_mb'] > max(reference['peak_mb']*(1+memory_tolerance),
+                                     reference['peak_mb']+memory_slack):
+            regressions.append(stage+': '+format(measured['peak_mb'], '.1f')+' MB, baseline '
+                               +format(reference['peak_mb'], '.1f')+' MB')
+
+    return regressions
+
+
+def main(argv=None):
+    """
+    Generates synthetic inputs at the requested scale, measures every stage and
+    compares the measurements with the baseline stored for that scale and level.
+    Exits with status 1 when a stage regressed or the mobility frames take more
+    memory per row than BYTES_PER_ROW allows, or when importing the headless entry
+    points takes longer than `--import-budget` seconds or loads any of the
+    DEFERRED_MODULES (GUI, clustering and optional engine libraries). With `--engine polars` the results of
+    both engines are also compared, for the full period and its second half with
+    every stringency reducer, and any difference fails the run.
+
+    Example:
+    ```
+    python benchmark.py --scale 2 --save-baseline
+    python benchmark.py --scale 2
+    ```
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark of the pipeline stages on synthetic data.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale factor of the synthetic data (40 countries at 1)')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--level', default='country', choices=utils.REGION_LEVELS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', default='pandas', choices=['pandas', 'polars'])
+    parser.add_argument('--data-dir', default=None,
+                        help='keep the synthetic inputs here and reuse them on later runs')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--time-tolerance', type=float, default=0.5)
+    parser.add_argument('--memory-tolerance', type=float, default=0.2)
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+                        help='seconds allowed to import main.py and service.py')
+
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        data_dir = args.data_dir or directory
+        os.makedirs(data_dir, exist_ok=True)
+
+        if not os.path.exists(os.path.join(data_dir, 'Global_Mobility_Report.csv')):
+            generate_mobility(os.path.join(data_dir, 'Global_Mobility_Report.csv'), args.scale,
+                              args.days, seed=args.seed)
+            generate_stringency(os.path.join(data_dir, 'OxCGRT_timeseries_all.xlsx'), args.scale,
+                                days=args.days+100, seed=args.seed)
+
+        results, footprint = run(data_dir, directory, args.level, seed=args.seed, engine=args.engine)
+
+        differences = []
+        if args.engine == 'polars':
+            import lazy
+            mobility_file = os.path.join(data_dir, 'Global_Mobility_Report.csv')
+            stringency = utils.DataReader(os.path.join(data_dir, 'OxCGRT_timeseries_all.xlsx')).read()[1]
+            first_date, last_date, base_date = lazy.LazyPreProcessor(mobility_file, stringency,
+                                                                     level=args.level).get_dates()
+            windows = [(first_date, last_date), (first_date+(last_date-first_date)/2, last_date)]
+            differences = ['engines differ for '+difference for difference in
+                           lazy.compare_engines(mobility_file, stringency, windows, args.level,
+                                                utils.STRINGENCY_REDUCERS)]
+
+    for stage in STAGES:
+        print(stage.ljust(20)+format(results[stage]['seconds'], '9.3f')+' s'
+              +format(results[stage]['peak_mb'], '10.1f')+' MB')
+
+    imports = import_times()
+    slow_imports = []
+    for module, measured in imports.items():
+        print(('import '+module).ljust(20)+format(measured['seconds'], '9.3f')+' s')
+        if measured['seconds'] > args.import_budget:
+            slow_imports.append('import '+module+': '+format(measured['seconds'], '.3f')
+                                +' s, budget '+format(args.import_budget, '.3f')+' s')
+        slow_imports += ['import '+module+' loads '+name for name in measured['loaded']]
+
+    oversized = [name+': '+format(footprint[name], '.1f')+' bytes per row, budget '
+                 +str(BYTES_PER_ROW[name]) for name in footprint if footprint[name] > BYTES_PER_ROW[name]]
+    for name in footprint:
+        print(name.ljust(20)+format(footprint[name], '9.1f')+' bytes per row')
+
+    key = 'scale='+str(args.scale)+',days='+str(args.days)+',level='+args.level\
+        +(',engine='+args.engine if args.engine != 'pandas' else '')
+
+    try:
+        with open(args.baseline) as handle:
+            baselines = json.load(handle)
+    except (OSError, ValueError):
+        baselines = {}
+
+    if args.save_baseline:
+        baselines[key] = results
+        with open(args.baseline, 'w') as handle:
+            json.dump(baselines, handle, indent=2)
+        regressions = []
+    elif key not in baselines:
+        print('No baseline stored for '+key+'; run with --save-baseline first.')
+        regressions = []
+    else:
+        regressions = compare(results, baselines[key], args.time_tolerance, args.memory_tolerance)
+
+    regressions += oversized+slow_imports+differences
+    for regression in regressions:
+        print('REGRESSION '+regression)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Clustering of the grouped mobility and stringency features: single fits, k selection
+and parallel runs over many date windows and cluster counts.
+
+@author: Anna Davy
+"""
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import utils
+
+# scikit-learn and threadpoolctl are imported by the functions using them, so that
+# importing this module (e.g. from main.py) stays cheap until the first fit
+
+
+MINIBATCH_SAMPLES = 10000
+
+SILHOUETTE_SAMPLES = 10000
+
+_cube = None
+
+
+def _single_thread():
+    """Worker initializer: keeps the BLAS/OpenMP pools of every process to one thread."""
+
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(limits=1)
+
+
+def _attach(directory, cube_class):
+    """Worker initializer: maps the shared feature arrays and keeps KMeans single-threaded."""
+
+    global _cube
+
+    _cube = cube_class.load(directory)
+    _single_thread()
+
+
+def features(data_final):
+    """Returns the feature matrix of the grouped data: the stringency value and mobility means."""
+
+    return data_final[['stringency_value']+utils.MOBILITY_COLUMNS].to_numpy(dtype='float64')
+
+
+def make_model(n_samples, n_clusters, random_state=None, init=None):
+    """
+    KMeans, or MiniBatchKMeans once there are at least MINIBATCH_SAMPLES rows to cluster;
+    `init` gives starting centroids (one run) instead of the k-means++ restarts.
+    """
+
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    options = {'init': init, 'n_init': 1} if init is not None else {'n_init': 'auto'}
+
+    if n_samples >= MINIBATCH_SAMPLES:
+        return MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, **options)
+
+    return KMeans(n_clusters=n_clusters, random_state=random_state, **options)
+
+
+@utils.instrumented('clustering', frames=lambda matrix: matrix)
+def fit_clusters(matrix, n_clusters, random_state=None, standardise=False, init=None):
+    """
+    Fits one clustering model and returns its labels with the fitted model; the labels
+    of the fit are used directly instead of predicting on the same matrix again.
+    """
+
+    if standardise:
+        from sklearn.preprocessing import StandardScaler
+        matrix = StandardScaler().fit_transform(matrix)
+
+    model = make_model(len(matrix), n_clusters, random_state, init).fit(matrix)
+
+    return model.labels_, model
+
+
+def _diagnose(matrix, n_clusters, random_state):
+
+    from sklearn.metrics import silhouette_score
+
+    labels, model = fit_clusters(matrix, n_clusters, random_state)
+
+    if 1 < n_clusters < len(matrix):
+        silhouette = silhouette_score(matrix, labels, random_state=random_state,
+                                      sample_size=min(len(matrix), SILHOUETTE_SAMPLES))
+    else:
+        silhouette = np.nan
+
+    return {'k': n_clusters, 'inertia': model.inertia_, 'silhouette': silhouette,
+            'model': type(model).__name__, 'samples': len(matrix)}
+
+
+@utils.instrumented('k_selection', frames=lambda matrix: matrix)
+def sweep_k(matrix, ks, random_state=0, standardise=True, workers=None):
+    """
+    Fits a model for every cluster count in `ks` in parallel processes and reports
+    the inertia and the (sampled) silhouette score of each.
+
+    The matrix is standardised once before the sweep and every fit uses the same
+    seed, so repeated sweeps give the same diagnostics.
+
+    Returns:
+        a data frame with one row per k ('k', 'inertia', 'silhouette', 'model',
+        'samples') and the k with the highest silhouette score
+    """
+
+    matrix = np.asarray(matrix, dtype='float64')
+    if len(matrix) == 0:
+        return pd.DataFrame(columns=['k','inertia','silhouette','model','samples']), None
+    if standardise:
+        from sklearn.preprocessing import StandardScaler
+        matrix = StandardScaler().fit_transform(matrix)
+
+    ks = [k for k in ks if k <= len(matrix)]
+    workers = min(workers or os.cpu_count(), len(ks))
+
+    if workers <= 1:
+        rows = [_diagnose(matrix, k, random_state) for k in ks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_single_thread) as pool:
+            rows = list(pool.map(_diagnose, [matrix]*len(ks), ks, [random_state]*len(ks)))
+
+    diagnostics = pd.DataFrame(rows, columns=['k','inertia','silhouette','model','samples'])
+
+    if diagnostics['silhouette'].notna().any():
+        best = int(diagnostics.loc[diagnostics['silhouette'].idxmax(), 'k'])
+    else:
+        best = None
+
+    return diagnostics, best
+
+
+def cluster_window(cube, from_date, to_date, n_clusters, random_state=None, standardise=False,
+                   reducer='peak'):
+    """
+    Groups the countries of one window, summarising their stringency with `reducer`
+    (see utils.reduce_buckets), and fits a clustering model with `n_clusters`.
+
+    Returns:
+        the grouped data with the window, the cluster count and the cluster label
+        in the 'group' column, or None if the window has fewer countries than clusters
+    """
+
+    data_final = cube.window(from_date, to_date, reducer)
+
+    if len(data_final) < n_clusters:
+        return None
+
+    labels, model = fit_clusters(features(data_final), n_clusters, random_state, standardise)
+
+    data_final['group'] = labels
+    data_final.insert(0, 'k', n_clusters)
+    data_final.insert(0, 'to_date', to_date)
+    data_final.insert(0, 'from_date', from_date)
+
+    return data_final
+
+
+def align_labels(centers, previous):
+    """
+    Matches the centroids of a fit to those of the previous fit (minimum total
+    distance) and returns the label each new cluster takes, so that a regime keeps
+    its label from one window to the next.
+    """
+
+    from scipy.optimize import linear_sum_assignment
+
+    distances = np.linalg.norm(centers[:, None, :]-previous[None, :, :], axis=-1)
+    rows, columns = linear_sum_assignment(distances)
+    mapping = np.empty(len(centers), dtype='int64')
+    mapping[rows] = columns
+
+    return mapping
+
+
+def rolling_windows(bucket_labels, begin, end, days, width=1, step=None):
+    """
+    Returns the sliding windows of `width` 2-week buckets, starting every `step`
+    buckets (`width` by default, giving consecutive windows), as (first bucket,
+    past-the-end bucket, from date, to date) tuples.
+    """
+
+    step = step or width
+    first_buckets = range(0, max(len(bucket_labels)-width, 0)+1, step) if len(bucket_labels) else []
+
+    return [(first, min(first+width, len(bucket_labels)), days[begin[first]].date(),
+             days[end[min(first+width, len(bucket_labels))-1]-1].date()) for first in first_buckets]
+
+
+@utils.instrumented('temporal_clustering')
+def temporal_clusters(index, from_date, to_date, n_clusters, width=1, step=None, random_state=None,
+                      standardise=False, reducer='peak'):
+    """
+    Clusters the countries of every rolling window of 2-week buckets in the period.
+
+    The bucket totals of the whole period are taken once from the utils.PrefixIndex
+    and the features of every window (the grouped data of `PrefixIndex.window` for
+    its dates) are computed from them, without another pass over the days. Each
+    window is fitted starting from the centroids of the previous one and its labels
+    are aligned to them (`align_labels`), so a label denotes the same regime across
+    windows. Windows with fewer countries than clusters are left unlabelled and the
+    next window starts from the last centroids found. With `standardise` one scaler
+    is fitted on the features of all windows and applied to each, so that the
+    centroids of consecutive windows are in the same units.
+
+    Returns:
+        the label matrix (one row per country, one column per window
+        '<from>_<to>', missing where the country is not grouped in the window) and
+        the transition counts between consecutive windows ('from_group' rows and
+        one column per group reached)
+    """
+
+    bucket_labels, begin, end, sums, counts, rows, means = index.bucket_totals(from_date, to_date)
+    labels = pd.DataFrame({'country': index.countries})
+    positions = pd.Index(index.countries)
+    centers = None
+
+    windows = [(window_from, window_to,
+                utils.FeatureCube.window_features(index.countries, bucket_labels[first:last],
+                                                  sums[:, first:last], counts[:, first:last],
+                                                  rows[:, first:last], means[:, first:last], reducer))
+               for first, last, window_from, window_to in rolling_windows(bucket_labels, begin, end,
+                                                                          index.days, width, step)]
+
+    scale = None
+    if standardise and any(len(data_final) for _, _, data_final in windows):
+        from sklearn.preprocessing import StandardScaler
+        scale = StandardScaler().fit(np.vstack([features(data_final) for _, _, data_final in windows]))
+
+    for window_from, window_to, data_final in windows:
+
+        column = pd.Series(pd.NA, index=labels.index, dtype='Int16')
+
+        if len(data_final) >= n_clusters:
+            matrix = features(data_final) if scale is None else scale.transform(features(data_final))
+            window_labels, model = fit_clusters(matrix, n_clusters, random_state, init=centers)
+            mapping = np.arange(n_clusters) if centers is None else align_labels(model.cluster_centers_,
+                                                                                 centers)
+            centers = model.cluster_centers_[np.argsort(mapping)]
+            column.iloc[positions.get_indexer(data_final['country'])] = mapping[window_labels]
+
+        labels[str(window_from)+'_'+str(window_to)] = column
+
+    window_labels = labels.iloc[:, 1:].to_numpy(dtype='float64', na_value=np.nan)
+    pairs = np.stack([window_labels[:, :-1].ravel(), window_labels[:, 1:].ravel()], axis=1)
+    pairs = pairs[~np.isnan(pairs).any(axis=1)].astype('int64')
+
+    transitions = pd.DataFrame(np.bincount(pairs[:, 0]*n_clusters+pairs[:, 1],
+                                           minlength=n_clusters*n_clusters).reshape(n_clusters, n_clusters),
+                               columns=[str(group) for group in range(n_clusters)])
+    transitions.insert(0, 'from_group', np.arange(n_clusters))
+
+    return labels, transitions
+
+
+def _cluster_shared(from_date, to_date, n_clusters, random_state, standardise, reducer):
+
+    return cluster_window(_cube, from_date, to_date, n_clusters, random_state, standardise, reducer)
+
+
+class ClusteringEngine:
+    """
+    Runs the KMeans grouping for a grid of date windows and cluster counts.
+
+    The country x day feature arrays are built once from a DataPreProcessor
+    (see utils.FeatureCube); `from_cube` also accepts a regions.RegionCube for
+    sub-national levels. With more than one worker they are written to .npy
+    files in a temporary directory and every worker process maps them read-only,
+    so the data is never pickled; each task only receives its window and k.
+
+    Attributes:
+        cube (FeatureCube): The feature arrays shared by all tasks.
+        workers (int): Number of worker processes, all cores by default.
+        random_state (int): Seed passed to the clustering models.
+        standardise (bool): If True, features are standardised before clustering.
+        reducer (str): Stringency summary of every window (see utils.STRINGENCY_REDUCERS).
+
+    Example:
+    ```
+    engine = ClusteringEngine(processor)
+    results = engine.run([(first_date, last_date), (from_date, to_date)], [3, 4, 5])
+    ```
+    """
+
+    def __init__(self, processor, workers=None, random_state=None, standardise=False, reducer='peak'):
+
+        self.cube = utils.FeatureCube.from_processor(processor) if processor is not None else None
+        self.workers = workers or os.cpu_count()
+        self.random_state = random_state
+        self.standardise = standardise
+        self.reducer = reducer
+
+    @classmethod
+    def from_cube(cls, cube, workers=None, random_state=None, standardise=False, reducer='peak'):
+        """Creates an engine over already built feature arrays, e.g. from an incremental store."""
+
+        engine = cls(None, workers, random_state, standardise, reducer)
+        engine.cube = cube
+
+        return engine
+
+    def select_k(self, from_date, to_date, ks):
+        """
+        Runs `sweep_k` on the grouped data of one window, seeded with `random_state`
+        (0 if unset) and standardised like the fits of `run`.
+
+        Returns:
+            the per-k diagnostics (with the window added) and the selected k
+        """
+
+        matrix = features(self.cube.window(from_date, to_date, self.reducer))
+        diagnostics, best = sweep_k(matrix, ks, random_state=self.random_state or 0,
+                                    standardise=self.standardise, workers=self.workers)
+
+        diagnostics.insert(0, 'to_date', to_date)
+        diagnostics.insert(0, 'from_date', from_date)
+
+        return diagnostics, best
+
+    @utils.instrumented('clustering_grid')
+    def run(self, windows, ks):
+        """
+        Clusters every (window, k) pair.
+
+        Returns:
+            one data frame with the results of all pairs, identified by the
+            'from_date', 'to_date' and 'k' columns
+        """
+
+        grid = [(from_date, to_date, k) for from_date, to_date in windows for k in ks]
+
+        if self.workers == 1 or len(grid) == 1:
+            results = [cluster_window(self.cube, *task, self.random_state, self.standardise,
+                                      self.reducer) for task in grid]
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                self.cube.save(directory)
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(grid)),
+                                         initializer=_attach,
+                                         initargs=(directory, type(self.cube))) as pool:
+                    futures = [pool.submit(_cluster_shared, *task, self.random_state,
+                                           self.standardise, self.reducer) for task in grid]
+                    results = [future.result() for future in futures]
+
+        results = [result for result in results if result is not None]
+
+        if len(results) == 0:
+            return pd.DataFrame(columns=['from_date', 'to_date', 'k'])
+
+        return pd.concat(results, ignore_index=True)
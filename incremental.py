@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental updates of the preprocessed feature arrays from new data snapshots.
+
+@author: Anna Davy
+"""
+import os
+import json
+from datetime import timedelta
+import utils
+
+
+class IncrementalStore:
+    """
+    A persisted utils.FeatureCube that is brought up to date from new snapshots of
+    the Google mobility and OxCGRT files without reprocessing their full history.
+
+    The cube keeps per-country, per-day sums and counts of the mobility columns, so
+    the 2-week means of any window (including its trailing, still growing buckets)
+    are recomputed from these running totals when the clusters are refitted.
+
+    On `update` only the mobility rows dated after the last stored day, minus
+    `overlap_days` days that are read again to pick up late reports, are streamed
+    from the new snapshot and appended. The stringency arrays are rebuilt from the
+    OxCGRT sheet each time as OxCGRT revises past values and the sheet is small.
+
+    Attributes:
+        directory (str): Directory holding the cube and the store state.
+        level (str): Aggregation level of the mobility rows (see utils.REGION_LEVELS).
+        overlap_days (int): Number of already stored days that are re-ingested.
+        indicator (str): OxCGRT indicator stored as stringency, the first sheet of the
+            workbook (or the stringency index of a CSV) by default.
+
+    Example:
+    ```
+    store = IncrementalStore('mobility_store')
+    cube = store.update('Global_Mobility_Report.csv', 'OxCGRT_timeseries_all.xlsx')
+    results = clustering.ClusteringEngine.from_cube(cube).run(windows, [4])
+    ```
+    """
+
+    def __init__(self, directory, level='country', overlap_days=0, cache_dir=None, indicator=None):
+
+        self.directory = directory
+        self.level = level
+        self.overlap_days = overlap_days
+        self.cache_dir = cache_dir
+        self.indicator = indicator
+        self.state_path = os.path.join(self.directory, 'store.json')
+
+    def load(self):
+        """Returns the stored cube, or None if the store is empty or was built for another level."""
+
+        try:
+            with open(self.state_path) as handle:
+                state = json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+        if state['level'] != self.level:
+            return None
+
+        return utils.FeatureCube.load(self.directory, mmap_mode=None)
+
+    def update(self, mobility_file, stringency_file):
+        """
+        Appends the new days of the given snapshots to the stored cube and saves it.
+
+        Returns:
+            the updated FeatureCube
+        """
+
+        cube = self.load()
+
+        if cube is None or len(cube.days) == 0:
+            from_date = None
+        else:
+            from_date = (cube.days[-1] - timedelta(days=self.overlap_days - 1)).date()
+
+        input_files = utils.DataReader(mobility_file, stringency_file, streaming=True,
+                                       level=self.level, from_date=from_date,
+                                       cache_dir=self.cache_dir,
+                                       indicators=[self.indicator] if self.indicator else None)
+        data,stringency = input_files.read()
+
+        # the snapshot has no day after the stored ones (same file or not yet published)
+        if cube is not None and len(data) == 0:
+            cube.stringency = utils.FeatureCube.stringency_matrix(stringency, cube.countries, cube.days)
+        else:
+            processor = utils.DataPreProcessor(data, stringency)
+            appended = utils.FeatureCube.from_processor(processor)
+
+            cube = appended if cube is None else cube.extend(appended)
+            cube.stringency = utils.FeatureCube.stringency_matrix(processor.source_stringency,
+                                                                  cube.countries, cube.days)
+
+        cube.save(self.directory)
+        with open(self.state_path, 'w') as handle:
+            json.dump({'level': self.level,
+                       'last_date': str(cube.days[-1].date()) if len(cube.days) else None}, handle)
+
+        return cube
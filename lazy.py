@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core engine of the DataPreProcessor pipeline on Polars lazy queries.
+
+@author: Anna Davy
+"""
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import polars as pl
+import utils
+
+
+ENGINES = ('pandas', 'polars')
+
+
+class LazyPreProcessor(utils.DataPreProcessor):
+    """
+    A utils.DataPreProcessor whose mobility data is a Polars lazy query over the
+    Google CSV, or a Parquet copy of it, instead of a data frame held in memory.
+
+    Column pruning, the aggregation level and date filters, the removal and renaming
+    of countries, the 2-week bucketing and the grouping are all part of the query,
+    which Polars runs multi-threaded on its streaming engine, so only the grouped
+    sums are ever materialised. `get_dates`, `format_main_data`, `format_stringency`
+    and `group_data` keep the contract of the pandas engine, except that the data
+    returned by `format_main_data` is a LazyFrame whose 'week_year' and '2weeks'
+    columns hold the integer week and bucket ids. The OxCGRT sheet is small and is
+    handled by the inherited pandas code.
+
+    With a `cache_dir` the pruned CSV is written once to Parquet, keyed by the
+    source fingerprint like the utils.FileCache entries, and later runs scan the
+    Parquet file instead of parsing the CSV.
+
+    Attributes:
+        mobility_file (str): The Google mobility CSV.
+        stringency (DataFrame): The OxCGRT sheet.
+        level (str): Aggregation level kept (see utils.REGION_LEVELS); None keeps
+            the rows of every level.
+        cache (FileCache): Cache of the Parquet copy, used when a `cache_dir` is given.
+
+    Example:
+    ```
+    processor = LazyPreProcessor('Global_Mobility_Report.csv', stringency, cache_dir='.mobility_cache')
+    first_date, last_date, base_date = processor.get_dates()
+    processor.format_main_data(first_date, last_date)
+    processor.format_stringency(first_date, last_date)
+    data_final = processor.group_data()
+    ```
+
+    Note:
+    - Dates are taken in chronological order: the first and last dates are the
+      earliest and latest ones and weeks are paired in date order, as the pandas
+      engine does on the date-sorted Google file.
+    - `source_data` collects the pruned and filtered rows into a compact pandas
+      frame, for the consumers that need the rows themselves (regions.RegionCube).
+    """
+
+    def __init__(self, mobility_file, stringency, level='country', cache_dir=None):
+
+        if level is not None and level not in utils.REGION_LEVELS:
+            raise ValueError("level must be one of "+str(utils.REGION_LEVELS))
+
+        self.mobility_file = mobility_file
+        self.level = level
+        self.cache = utils.FileCache(cache_dir) if cache_dir is not None else None
+        self.stringency = stringency
+        self.source_stringency = stringency
+        self.source = self.scan()
+        self.data = self.source
+        self.unique_dates = None
+        self.collected = None
+
+    def scan(self):
+        """Returns the lazy query of the mobility rows of the selected level."""
+
+        names = pl.scan_csv(self.mobility_file).collect_schema().names()
+        columns = [column for column in utils.REGION_COLUMNS+['date']+utils.MOBILITY_COLUMNS
+                   if column in names]
+        schema = {column: pl.Float32 if column in utils.MOBILITY_COLUMNS else pl.String
+                  for column in columns}
+
+        query = pl.scan_csv(self.mobility_file, schema_overrides=schema).select(columns)\
+            .with_columns(pl.col('date').str.to_date('%Y-%m-%d', strict=False))
+
+        if self.cache is not None:
+            key = self.cache.key(self.mobility_file, engine='polars', columns=columns)
+            path = self.cache.path(key, '.parquet')
+            if not os.path.exists(path):
+                query.sink_parquet(path+'.tmp')
+                os.replace(path+'.tmp', path)
+                self.cache.register(key, self.mobility_file)
+            query = pl.scan_parquet(path)
+
+        if self.level is not None:
+            target = utils.REGION_LEVELS.index(self.level)
+            for position, level_column in enumerate(utils.REGION_COLUMNS[1:], start=1):
+                if level_column not in columns:
+                    continue
+                if position == target:
+                    query = query.filter(pl.col(level_column).is_not_null())
+                elif position > target or level_column == 'metro_area':
+                    query = query.filter(pl.col(level_column).is_null())
+            columns = [column for column in columns
+                       if column not in utils.REGION_COLUMNS[target+1:]]
+
+        return query.filter(~pl.col('country_region').is_in(self.to_be_removed))\
+            .with_columns(pl.col('country_region').replace(self.country_dict)).select(columns)
+
+    def dates(self):
+        """Returns the sorted dates of the mobility data, collected once."""
+
+        if self.unique_dates is None:
+            dates = self.source.select(pl.col('date').unique().drop_nulls().sort())\
+                .collect(engine='streaming')
+            self.unique_dates = pd.DatetimeIndex(dates['date'].to_list())
+
+        return self.unique_dates
+
+    def get_dates(self):
+
+        dates = self.dates()
+        base_date = datetime(datetime.now().year - 10, 12, 1).date()
+
+        return dates[0].date(), dates[-1].date(), base_date
+
+    @utils.instrumented('format_main_data')
+    def format_main_data(self, from_date, to_date):
+        """
+        Restricts the mobility query to the given period and joins the ISO week and
+        2-week bucket of every date, Saturdays being left out.
+
+        Returns:
+            the lazy data, a dictionary of date -> (week, year) and a dictionary of
+            str((week, year)) -> 2-week bucket label
+        """
+
+        dates = self.dates()
+        dates = dates[(dates >= pd.Timestamp(from_date)) & (dates <= pd.Timestamp(to_date))]
+        week_codes, weekdays = self.assign_weeks(dates)
+        weeks = np.array(self.weeks, dtype='int64').reshape(-1, 2)[week_codes]
+
+        calendar = pl.LazyFrame({'date': pl.Series([day.date() for day in dates[weekdays]], dtype=pl.Date),
+                                 'week': pl.Series(weeks[weekdays, 0], dtype=pl.Int16),
+                                 'year': pl.Series(weeks[weekdays, 1], dtype=pl.Int16),
+                                 'week_year': pl.Series(week_codes[weekdays], dtype=pl.Int32),
+                                 '2weeks': pl.Series(week_codes[weekdays]//2, dtype=pl.Int32)})
+
+        self.data = self.source.filter(pl.col('date').is_between(from_date, to_date))\
+            .join(calendar, on='date', how='inner')
+
+        return self.data, self.date_dict, self.dict_weeks
+
+    def grouped_sums(self, key, codes):
+        """
+        Groups the formatted data ('2weeks') or the full data ('date') by country and
+        `key` and returns the countries (sorted) with the dense sums, non-missing
+        counts and row numbers per country x key; `codes` maps the key values to
+        their positions and gives the number of positions.
+        """
+
+        grouped = self.data if key == '2weeks' else self.source
+        grouped = grouped.filter(pl.col('country_region').is_not_null())\
+            .group_by(['country_region', key])\
+            .agg([pl.len().alias('rows')]
+                 +[pl.col(column).cast(pl.Float64).sum().alias('sum_'+str(position))
+                   for position, column in enumerate(utils.MOBILITY_COLUMNS)]
+                 +[pl.col(column).count().alias('count_'+str(position))
+                   for position, column in enumerate(utils.MOBILITY_COLUMNS)])\
+            .collect(engine='streaming')
+
+        countries = pd.Index(sorted(grouped['country_region'].unique().to_list()))
+        country_codes = countries.get_indexer(grouped['country_region'].to_list())
+        key_codes, size = codes(grouped[key])
+        n_columns = len(utils.MOBILITY_COLUMNS)
+
+        sums = np.zeros((len(countries), size, n_columns))
+        counts = np.zeros((len(countries), size, n_columns))
+        rows = np.zeros((len(countries), size), dtype='int64')
+        sums[country_codes, key_codes] = grouped.select(['sum_'+str(position)
+                                                         for position in range(n_columns)]).to_numpy()
+        counts[country_codes, key_codes] = grouped.select(['count_'+str(position)
+                                                           for position in range(n_columns)]).to_numpy()
+        rows[country_codes, key_codes] = grouped['rows'].to_numpy()
+
+        return countries, sums, counts, rows
+
+    def bucket_sums(self):
+
+        return self.grouped_sums('2weeks', lambda buckets: (buckets.to_numpy(), len(self.bucket_labels)))
+
+    def day_sums(self):
+
+        days = self.dates()
+        countries, sums, counts, rows = self.grouped_sums(
+            'date', lambda dates: (days.get_indexer(pd.DatetimeIndex(dates.to_list())), len(days)))
+
+        return list(countries), days, sums, counts, rows
+
+    @property
+    def source_data(self):
+
+        if self.collected is None:
+            rows = self.source.with_columns(pl.col('date').dt.strftime('%Y-%m-%d'))\
+                .collect(engine='streaming').to_pandas()
+            self.collected = utils.compact_mobility(rows)
+
+        return self.collected
+
+
+def make_processor(engine, mobility_file, stringency, level='country', cache_dir=None, streaming=True):
+    """
+    Returns the preprocessor of the given engine: a utils.DataPreProcessor over the
+    mobility file read by utils.DataReader ('pandas') or a LazyPreProcessor ('polars').
+    """
+
+    if engine == 'polars':
+        return LazyPreProcessor(mobility_file, stringency, level=level, cache_dir=cache_dir)
+
+    data, _ = utils.DataReader(mobility_file, streaming=streaming, level=level, cache_dir=cache_dir).read()
+
+    return utils.DataPreProcessor(data, stringency)
+
+
+def compare_engines(mobility_file, stringency, windows, level='country', reducers=('peak',)):
+    """
+    Runs the pandas and Polars engines on the given windows and reducers.
+
+    Returns:
+        a description of every window and reducer whose `group_data` output differs
+        (beyond float32 rounding) between the engines; empty when they agree
+    """
+
+    processors = [make_processor(engine, mobility_file, stringency, level) for engine in ENGINES]
+    differences = []
+
+    for from_date, to_date in windows:
+
+        for processor in processors:
+            processor.format_main_data(from_date, to_date)
+            processor.format_stringency(from_date, to_date)
+
+        for reducer in reducers:
+            expected, result = [processor.group_data(reducer) for processor in processors]
+            try:
+                pd.testing.assert_frame_equal(result, expected, check_dtype=False,
+                                              check_categorical=False, rtol=1e-6)
+            except AssertionError as error:
+                differences.append(str(from_date)+' - '+str(to_date)+' ('+reducer+'): '
+                                   +str(error).splitlines()[0])
+
+    return differences
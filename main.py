@@ -5,8 +5,332 @@ Created on Mon May 15 11:39:30 2023
 @author: Anna Davy
 """
 
+import os
+import sys
+import json
+import argparse
+from datetime import date
+import pandas as pd
 import utils
-from sklearn.cluster import KMeans
+
+
+def parse_window(window, first_date=None, last_date=None):
+    """
+    Converts a window given as 'all' or 'YYYY-MM-DD:YYYY-MM-DD' into a pair of dates
+    clipped to the available data, when its first and last dates are given. Either
+    side of the colon may be left empty. Raises ValueError on a malformed window or
+    one that ends before it starts.
+    """
+    
+    if window=='all':
+        return first_date, last_date
+    
+    try:
+        from_text, to_text = window.split(':')
+        from_date = date.fromisoformat(from_text) if from_text else None
+        to_date = date.fromisoformat(to_text) if to_text else None
+    except ValueError:
+        raise ValueError("expected 'all' or 'YYYY-MM-DD:YYYY-MM-DD', got '"+window+"'") from None
+    
+    if from_date and to_date and from_date > to_date:
+        raise ValueError('the window '+window+' ends before it starts')
+    
+    if first_date is not None:
+        from_date = max(from_date, first_date) if from_date else first_date
+    if last_date is not None:
+        to_date = min(to_date, last_date) if to_date else last_date
+    
+    return from_date, to_date
+
+
+def batch(argv=None):
+    """
+    Runs the pipeline without any dialogs for every date window given on the command
+    line or in a JSON config file whose keys mirror the long option names (command
+    line options take precedence).
+
+    The input files are read and preprocessed once; the windows x cluster counts grid
+    is then clustered by a clustering.ClusteringEngine across `--workers` processes
+    and each result is written to '<output>/mobility_<from>_<to>.xlsx' (with a
+    '_k<k>' suffix when several cluster counts are requested), or in the `--format`
+    given; `--single-file` writes all results as sheets of one workbook, or as the
+    partitions of one 'mobility_<timestamp>' directory. A JSON run report with
+    the wall time, CPU time, RSS (start, end and peak) and frame shapes of every
+    stage is written to '<output>/run_report_<timestamp>.json'. With `--store` the
+    preprocessed arrays are kept in an incremental.IncrementalStore and only the days
+    added since the previous run are read from the mobility file. Below the country
+    level (`--level`) the entities are grouped by a regions.RegionCube. `--engine polars`
+    preprocesses the mobility file with a lazy.LazyPreProcessor query instead of
+    loading it into pandas. With several `--indicator` names every OxCGRT indicator is
+    clustered in turn (its value in the 'stringency_value' column) and the result
+    names get an '_<indicator>' suffix. `--mobility` may also be Google's
+    Region_Mobility_Report_CSVs.zip, whose members are read straight from the archive,
+    and `--countries` restricts the countries read. `--temporal` clusters the rolling windows of
+    2-week buckets inside each window instead (see clustering.temporal_clusters) and
+    writes 'temporal_labels_<from>_<to>' and 'temporal_transitions_<from>_<to>'.
+
+    Example:
+    ```
+    python main.py --window all --window 2020-03-01:2020-06-30 --clusters 3 4 5 --output results
+    ```
+    """
+    
+    parser = argparse.ArgumentParser(description='Country groups from mobility and stringency data.')
+    parser.add_argument('--config', help='JSON file with default values for the options below')
+    parser.add_argument('--mobility', default='Global_Mobility_Report.csv',
+                        help='Google mobility CSV or Region_Mobility_Report_CSVs.zip archive')
+    parser.add_argument('--countries', nargs='+', default=None,
+                        help='ISO codes of the countries to read (e.g. PL DE), all by default')
+    parser.add_argument('--stringency', default='OxCGRT_timeseries_all.xlsx',
+                        help='OxCGRT timeseries workbook, wide timeseries CSV or long CSV')
+    parser.add_argument('--indicator', nargs='+', default=None,
+                        help='OxCGRT indicators to cluster on (e.g. stringency_index '
+                        'containment_health_index), each giving its own results; the first '
+                        'sheet of the workbook or the stringency index of a CSV by default')
+    parser.add_argument('--output', default='.')
+    parser.add_argument('--format', default='xlsx', choices=list(utils.OUTPUT_FORMATS),
+                        help='output format of the results')
+    parser.add_argument('--single-file', action='store_true',
+                        help='write all results as sheets (xlsx) or partitions of one output')
+    parser.add_argument('--window', dest='windows', action='append',
+                        help="'all' or 'YYYY-MM-DD:YYYY-MM-DD', may be repeated")
+    parser.add_argument('--clusters', type=int, nargs='+', default=[4])
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, all cores by default')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--reducer', default='peak', choices=utils.STRINGENCY_REDUCERS,
+                        help='stringency summary of every window: the peak 2-week bucket (default), '
+                        'the mean or median of the buckets or the last bucket')
+    parser.add_argument('--standardise', action='store_true',
+                        help='standardise the features before clustering')
+    parser.add_argument('--select-k', action='store_true',
+                        help='pick the cluster count of each window by silhouette score among '
+                        '--clusters (2 to 10 if a single count is given)')
+    parser.add_argument('--temporal', action='store_true',
+                        help='cluster every rolling window of 2-week buckets of each --window and '
+                        'write the country x window labels and the transition counts')
+    parser.add_argument('--temporal-width', type=int, default=1,
+                        help='number of 2-week buckets per rolling window')
+    parser.add_argument('--temporal-step', type=int, default=None,
+                        help='buckets between the starts of rolling windows (--temporal-width by '
+                        'default, i.e. consecutive windows)')
+    parser.add_argument('--level', default='country', choices=utils.REGION_LEVELS)
+    parser.add_argument('--cache-dir', default='.mobility_cache')
+    parser.add_argument('--engine', default='pandas', choices=['pandas', 'polars'],
+                        help='polars runs the mobility preprocessing as a lazy, out-of-core query')
+    parser.add_argument('--store', default=None,
+                        help='directory of an incremental store updated from the input files')
+    parser.add_argument('--overlap-days', type=int, default=0,
+                        help='number of stored days read again on an incremental update')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile every stage with cProfile (statistics written next to the run report)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='record the tracemalloc peak of every stage in the run report')
+    
+    args = parser.parse_args(argv)
+    if args.config:
+        with open(args.config) as handle:
+            config = json.load(handle)
+        # keys may be given as the long option names or as their destinations
+        destinations = {option[2:].replace('-', '_'): action.dest for action in parser._actions
+                        for option in action.option_strings if option.startswith('--')}
+        destinations.update({dest: dest for dest in destinations.values()})
+        for name in ('help', 'config'):
+            destinations.pop(name)
+        unknown = [key for key in config if key.replace('-', '_') not in destinations]
+        if unknown:
+            parser.error('unknown keys in '+args.config+': '+', '.join(unknown))
+        config = {destinations[key.replace('-', '_')]: value for key, value in config.items()}
+        # an appending option would add the command line windows to those of the config
+        windows = args.windows or config.pop('windows', None)
+        if isinstance(windows, str):
+            windows = [windows]
+        parser.set_defaults(**config)
+        args = parser.parse_args(argv)
+        args.windows = windows
+        
+    for window in args.windows or []:
+        try:
+            parse_window(window)
+        except ValueError as error:
+            parser.error('--window: '+str(error))
+    if args.store and args.level!='country':
+        parser.error('--store keeps country level data only')
+    if args.store and args.engine!='pandas':
+        parser.error('--store reads the new snapshot days with the pandas engine only')
+    if any(not utils.is_index_indicator(indicator) for indicator in args.indicator or []):
+        parser.error('--indicator takes the 0-100 OxCGRT indices only (e.g. stringency_index, '
+                     'containment_health_index)')
+    if (args.indicator and len(args.indicator) > 1 and os.path.exists(args.stringency)
+            and utils.is_wide_oxcgrt(args.stringency)):
+        parser.error('a wide OxCGRT CSV holds a single indicator; use a workbook or a long CSV '
+                     'for several --indicator names')
+    if (args.store or args.engine!='pandas') and (args.countries or args.mobility.endswith('.zip')):
+        parser.error('--countries and zip archives are read by the pandas engine without --store')
+    if args.temporal and (args.level!='country' or args.select_k):
+        parser.error('--temporal clusters country level data with the given --clusters only')
+    if args.temporal_width < 1 or (args.temporal_step is not None and args.temporal_step < 1):
+        parser.error('--temporal-width and --temporal-step must be positive')
+        
+    with utils.RunReport(profile=args.profile, trace_memory=args.trace_memory) as report:
+        run_batch(args)
+        
+    report.write(os.path.join(args.output, 'run_report_'
+                              +report.started.strftime("%Y_%m_%d_%H_%M_%S")+'.json'))
+
+
+def run_batch(args):
+    """Runs the batch pipeline for the parsed command line options of `batch`."""
+    
+    import clustering
+    import incremental
+    import regions
+    
+    indicators = args.indicator or None
+    
+    if args.store:
+        
+        store = incremental.IncrementalStore(args.store, level=args.level, overlap_days=args.overlap_days,
+                                             cache_dir=args.cache_dir,
+                                             indicator=indicators[0] if indicators else None)
+        cube = store.update(args.mobility, args.stringency)
+        first_date, last_date = cube.days[0].date(), cube.days[-1].date()
+        
+        if indicators and len(indicators) > 1:
+            reader = utils.DataReader(args.stringency, cache_dir=args.cache_dir, indicators=indicators,
+                                      workers=args.workers)
+            reader.read()
+            sheets = reader.indicator_sheets
+        
+    else:
+        
+        if args.engine=='polars':
+            
+            import lazy
+            
+            input_files = utils.DataReader(args.stringency, cache_dir=args.cache_dir,
+                                           indicators=indicators, workers=args.workers)
+            data,stringency = input_files.read()
+            processor=lazy.LazyPreProcessor(args.mobility, stringency, level=args.level,
+                                            cache_dir=args.cache_dir)
+            
+        else:
+            
+            input_files = utils.DataReader(args.mobility, args.stringency, streaming=True,
+                                           level=args.level, cache_dir=args.cache_dir,
+                                           indicators=indicators, workers=args.workers,
+                                           countries=args.countries)
+            data,stringency = input_files.read()
+            
+            processor=utils.DataPreProcessor(data,stringency)
+            
+        sheets = input_files.indicator_sheets
+        first_date, last_date, base_date = processor.get_dates()
+        
+        if args.level=='country':
+            cube = utils.FeatureCube.from_processor(processor)
+        else:
+            cube = regions.RegionCube.from_processor(processor, args.level)
+    
+    # every window of a country level sweep is two lookups in the prefix sums
+    if args.level=='country':
+        cube = utils.PrefixIndex.from_cube(cube)
+    
+    windows = [parse_window(window, first_date, last_date) for window in args.windows or ['all']]
+    results, names = [], []
+    
+    # further indicators share the mobility arrays of the first one
+    for position, indicator in enumerate(indicators or [None]):
+        
+        indicator_cube = cube if position==0 else cube.with_stringency(sheets[indicator])
+        suffix = '_'+indicator if indicators and len(indicators) > 1 else ''
+        
+        if args.temporal:
+            cube_results, cube_names = temporal_windows(indicator_cube, windows, args)
+        else:
+            engine = clustering.ClusteringEngine.from_cube(indicator_cube, workers=args.workers,
+                                                           random_state=args.seed,
+                                                           standardise=args.standardise,
+                                                           reducer=args.reducer)
+            cube_results, cube_names = cluster_windows(engine, windows, args)
+        results += cube_results
+        names += [name+suffix for name in cube_names]
+            
+    writer=utils.DataWriter(*results, output_dir=args.output, names=names, single_file=args.single_file)
+    
+    writer.write(args.format)
+
+
+def cluster_windows(engine, windows, args):
+    """
+    Clusters the windows x cluster counts grid of the batch options with the engine.
+
+    Returns:
+        the result frames (and k selection diagnostics) and their names
+    """
+    
+    results, names = [], []
+    
+    if args.select_k:
+        
+        ks = args.clusters if len(args.clusters) > 1 else range(2, 11)
+        grids = []
+        
+        for from_date, to_date in windows:
+            
+            diagnostics, best = engine.select_k(from_date, to_date, ks)
+            results.append(diagnostics)
+            names.append('k_selection_'+str(from_date)+'_'+str(to_date))
+            
+            if best is not None:
+                grids.append(engine.run([(from_date, to_date)], [best]))
+                
+        grid = (pd.concat(grids, ignore_index=True) if grids
+                else pd.DataFrame(columns=['from_date','to_date','k']))
+        
+    else:
+        
+        grid = engine.run(windows, args.clusters)
+    
+    
+    for (from_date, to_date, k), data_final in grid.groupby(['from_date','to_date','k'], sort=False):
+        
+        results.append(data_final.drop(columns=['from_date','to_date','k']).reset_index(drop=True))
+        names.append(str(from_date)+'_'+str(to_date)+('_k'+str(k) if len(args.clusters)>1 
+                                                      and not args.select_k else ''))
+        
+    for from_date, to_date in windows:
+        if len(grid)==0 or not ((grid.from_date==from_date)&(grid.to_date==to_date)).any():
+            print ('No data to cluster for the period '+str(from_date)+' - '+str(to_date)+'.')
+            
+    return results, names
+
+
+def temporal_windows(index, windows, args):
+    """
+    Runs clustering.temporal_clusters over every window and cluster count of the
+    batch options.
+
+    Returns:
+        the label matrices and transition counts and their names
+    """
+    
+    import clustering
+    
+    results, names = [], []
+    
+    for from_date, to_date in windows:
+        for k in args.clusters:
+            
+            labels, transitions = clustering.temporal_clusters(index, from_date, to_date, k,
+                                                               args.temporal_width, args.temporal_step,
+                                                               args.seed, args.standardise, args.reducer)
+            suffix = str(from_date)+'_'+str(to_date)+('_k'+str(k) if len(args.clusters)>1 else '')
+            
+            results += [labels, transitions]
+            names += ['temporal_labels_'+suffix, 'temporal_transitions_'+suffix]
+            
+    return results, names
 
 
 def main():
@@ -14,71 +338,81 @@ def main():
     The main function of a data processing and analysis pipeline focused on global mobility and stringency data.
 
     Steps:
-    1. Reads input data from 'Global_Mobility_Report.csv' and 'OxCGRT_timeseries_all.xlsx' using a custom DataReader class.
-    2. Preprocesses the data using the DataPreProcessor class, extracting date-related information.
+    1. Reads input data from 'Global_Mobility_Report.csv' and 'OxCGRT_timeseries_all.xlsx' using a custom DataReader class,
+       streaming the mobility file and keeping only the country level rows. Parsed frames are cached
+       in '.mobility_cache' and reused while the source files are unchanged.
+    2. Preprocesses the data once into a PrefixIndex of per-country cumulative sums, kept in '.mobility_cache'
+       as well, so later runs and any date range selected are answered without reading the files again.
     3. Presents the user with a menu to choose between analyzing data for all available dates or a specific date range.
     4. If a specific date range is chosen, further processes the data to conform to the selected dates and checks the availability of stringency data.
     5. Formats and groups the main data and stringency data based on the user's selection.
-    6. Applies a KMeans clustering algorithm to the processed data, assigning cluster labels.
+    6. Applies a KMeans clustering algorithm to the processed data, assigning the cluster labels of the fit.
     7. Appends the cluster labels to the final data and writes the output to an Excel file using the DataWriter class.
+    8. Writes a JSON report with the time and memory used by every stage next to the output.
 
     Note:
     - The function is designed to be executed as the primary entry point of a script, with the main logic conditional on `__name__ == "__main__"`.
-    - Utilizes custom utility classes (DataReader, DataPreProcessor, DataWriter) for various data handling tasks.
+    - Utilizes custom utility classes (DataReader, DataPreProcessor, PrefixIndex, DataWriter) for various data handling tasks.
     - Employs a KMeans clustering model from the sklearn library to analyze the processed data.
     - Handles user input for date selection and manages data processing accordingly.
     - Ensures compatibility of selected dates with the available data range.
+    - Running the script with command line options starts the non-interactive `batch` mode instead.
+    - The dialogs come from the gui module, imported here only, so the batch mode runs without Tk.
     """
     
-    input_files = utils.DataReader('Global_Mobility_Report.csv','OxCGRT_timeseries_all.xlsx') 
-    data,stringency = input_files.read()  
+    import clustering
+    import gui
     
-    processor=utils.DataPreProcessor(data,stringency)
+    with utils.RunReport() as report:
+        
+        index = utils.PrefixIndex.cached('Global_Mobility_Report.csv','OxCGRT_timeseries_all.xlsx',
+                                         '.mobility_cache')
     
-    first_date, last_date, base_date = processor.get_dates()   
+        first_date, last_date = index.days[0].date(), index.days[-1].date()
+        base_date = date(date.today().year - 10, 12, 1)
        
                 
-    user_choice=utils.menu(choices=['1. All available dates from '+str(first_date)+" to "+str(last_date),
-                          '2. Choose dates from calendar'],
-                             title=" Please select an option: ",nr_rows=30)[0]
+        user_choice=gui.menu(choices=['1. All available dates from '+str(first_date)+" to "+str(last_date),
+                              '2. Choose dates from calendar'],
+                                 title=" Please select an option: ",nr_rows=30)[0]
     
-    if user_choice=='2. Choose dates from calendar':
+        if user_choice=='2. Choose dates from calendar':
         
-        per_dates = utils.PeriodExtract(base_date, base_date)
-        from_date = per_dates.todate
-        to_date = per_dates.frdate
+            per_dates = gui.PeriodExtract(base_date, base_date)
+            from_date = per_dates.todate
+            to_date = per_dates.frdate
         
-        if from_date < first_date:
-            from_date = first_date
+            if from_date < first_date:
+                from_date = first_date
             
-        if to_date > last_date:
-            to_date = last_date
+            if to_date > last_date:
+                to_date = last_date
             
-        data = processor.format_main_data(from_date,to_date)
-        
-        stringency = processor.format_stringency(from_date,to_date)
+        else:
         
-        if stringency.shape[1]<3:
+            from_date, to_date = first_date, last_date
+
+        data_final = index.window(from_date, to_date)
+    
+        if len(data_final)==0:
             
             print ('Stringency data not available for the selected period.')
             
-    else:
+        else:
             
-        data, date_dict, dict_weeks = processor.format_main_data(first_date, last_date)
-        stringency=processor.format_stringency(first_date, last_date, date_dict, dict_weeks)  
-
-    data_final =processor.group_data()
-    
-    model = KMeans(n_clusters=4).fit(data_final.drop(['country','2weeks'],axis=1))
-    labels = model.predict(data_final.drop(['country','2weeks'],axis=1))
-
-
-    data_final['group']=labels
+            labels, model = clustering.fit_clusters(clustering.features(data_final), 4)
+            data_final['group']=labels
+        
+            writer=utils.DataWriter(data_final)
     
-    writer=utils.DataWriter(data_final)
+            writer.write_to_excel()
     
-    writer.write_to_excel()
+    report.write('run_report_'+report.started.strftime("%Y_%m_%d_%H_%M_%S")+'.json')
+
 
 if __name__ == "__main__":
-    main()    
+    if len(sys.argv) > 1:
+        batch()
+    else:
+        main()    
     
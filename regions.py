@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Grouping of the mobility data below the country level (sub_region_1, sub_region_2
+and metro_area) paired with the national and subnational OxCGRT rows.
+
+@author: Anna Davy
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+import utils
+
+
+class RegionCube:
+    """
+    Integer-coded mobility rows of one aggregation level and the OxCGRT stringency
+    rows they are paired with, from which the grouped features of any period are
+    computed with bincount reductions.
+
+    Region keys are combined from the categorical codes of the key columns into one
+    integer entity code per row, so no string grouping happens after construction.
+    The rows are kept in long form (entity code, day code, float32 values), so the
+    memory used grows with the number of rows rather than entities x days; the
+    bucket sums of a window take entities x buckets.
+
+    Each entity is paired with the subnational OxCGRT row of its country and
+    sub_region_1 name (Jurisdiction 'STATE_TOTAL') when the sheet has one, and with
+    its national row otherwise. Entities without any stringency row are left out,
+    as countries missing from OxCGRT are at the country level.
+
+    Attributes:
+        level (str): Aggregation level (see utils.REGION_LEVELS).
+        keys (DataFrame): Region key columns of every entity.
+        days (DatetimeIndex): The dates of the mobility data, sorted.
+        entity_codes, day_codes (ndarray): Entity and day of every mobility row.
+        values (ndarray): Mobility percent changes of every row, shape (rows, 6).
+        stringency (ndarray): Stringency per OxCGRT row and day (missing values set
+            to 0, float64 so bucket means round as at the country level); NaN where
+            the day is not in the sheet.
+        entity_stringency (ndarray): OxCGRT row paired with every entity, -1 if none.
+
+    Like utils.FeatureCube, the arrays can be saved and loaded back memory-mapped,
+    so a RegionCube can be shared with the workers of clustering.ClusteringEngine.
+    """
+
+    arrays = ('entity_codes', 'day_codes', 'values', 'stringency', 'entity_stringency')
+
+    def __init__(self, level, keys, days, entity_codes, day_codes, values, stringency,
+                 entity_stringency):
+
+        self.level = level
+        self.keys = keys
+        self.days = days
+        self.entity_codes = entity_codes
+        self.day_codes = day_codes
+        self.values = values
+        self.stringency = stringency
+        self.entity_stringency = entity_stringency
+
+    @classmethod
+    @utils.instrumented('region_cube')
+    def from_processor(cls, processor, level='sub_region_1'):
+
+        data = processor.source_data
+        key_columns = utils.REGION_COLUMNS[:utils.REGION_LEVELS.index(level)+1]
+
+        combined = np.zeros(len(data), dtype='int64')
+        for column in key_columns:
+            column_codes, uniques = pd.factorize(data[column])
+            combined = combined*(len(uniques)+1)+(column_codes+1)
+
+        date_codes, unique_dates = pd.factorize(data['date'])
+        dates = utils.DataPreProcessor.parse_dates(np.asarray(unique_dates, dtype=object))
+        order = np.argsort(dates.to_numpy(), kind='stable')[:int(dates.notna().sum())]
+        rank = np.full(len(dates)+1, -1, dtype='int64')
+        rank[order] = np.arange(len(order))
+        day_codes = rank[date_codes]
+
+        keep = day_codes >= 0
+        entity_codes, _ = pd.factorize(combined[keep], sort=True)
+        first = np.unique(entity_codes, return_index=True)[1]
+        keys = data.loc[keep, key_columns].iloc[first].astype(object)
+        keys = keys.rename(columns={'country_region': 'country'}).reset_index(drop=True)
+
+        # entities are numbered in the order of their names
+        keys = keys.sort_values(keys.columns.tolist(), na_position='first')
+        renumber = np.empty(len(keys), dtype='int64')
+        renumber[keys.index.to_numpy()] = np.arange(len(keys))
+        entity_codes = renumber[entity_codes]
+        keys = keys.reset_index(drop=True)
+        days = pd.DatetimeIndex(dates[order])
+
+        stringency, entity_stringency = cls.pair_stringency(processor.source_stringency, keys, days)
+
+        return cls(level, keys, days, entity_codes.astype('int32'),
+                   day_codes[keep].astype('int32'),
+                   data.loc[keep, utils.MOBILITY_COLUMNS].to_numpy(dtype='float32'),
+                   stringency, entity_stringency)
+
+    @staticmethod
+    def pair_stringency(sheet, keys, days):
+        """
+        Selects the national and STATE_TOTAL rows of the OxCGRT sheet, aligns them to
+        the days and pairs every entity with one of them.
+        """
+
+        columns = [str(column).lower() for column in sheet.columns]
+        country_column = utils.DataPreProcessor.stringency_name_column(sheet.columns)
+        region_columns = [column for column, lower in zip(sheet.columns, columns)
+                          if 'region' in lower and 'name' in lower]
+        jurisdiction = [column for column, lower in zip(sheet.columns, columns)
+                        if 'jurisdiction' in lower]
+
+        if jurisdiction:
+            sheet = sheet[sheet[jurisdiction[0]].isin(['NAT_TOTAL', 'STATE_TOTAL'])]
+
+        regions = sheet[region_columns[0]] if region_columns else pd.Series(np.nan, index=sheet.index)
+        rows = {(country, None if pd.isna(region) else region): position
+                for position, (country, region) in enumerate(zip(sheet[country_column], regions))}
+
+        headers = utils.DataPreProcessor.parse_dates(np.asarray(sheet.columns.astype(str), dtype=object))
+        header_days = days.get_indexer(headers)
+
+        stringency = np.full((len(sheet), len(days)), np.nan)
+        stringency[:, header_days[header_days >= 0]] = np.nan_to_num(
+            sheet.iloc[:, np.flatnonzero(header_days >= 0)].to_numpy(dtype='float64'), nan=0.0)
+
+        regions = keys['sub_region_1'] if 'sub_region_1' in keys else pd.Series(None, index=keys.index)
+        entity_stringency = np.array([rows.get((country, region), rows.get((country, None), -1))
+                                      for country, region in zip(keys['country'], regions)],
+                                     dtype='int32')
+
+        return stringency, entity_stringency
+
+    def with_stringency(self, sheet):
+        """
+        Returns a cube sharing the mobility arrays of this one with the stringency of
+        another OxCGRT sheet, e.g. another indicator of the same release.
+        """
+
+        stringency, entity_stringency = self.pair_stringency(sheet, self.keys, self.days)
+
+        return RegionCube(self.level, self.keys, self.days, self.entity_codes, self.day_codes,
+                          self.values, stringency, entity_stringency)
+
+    def save(self, directory):
+
+        os.makedirs(directory, exist_ok=True)
+        for name in self.arrays:
+            np.save(os.path.join(directory, name+'.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'index.json'), 'w') as handle:
+            json.dump({'level': self.level, 'key_columns': self.keys.columns.tolist(),
+                       'keys': self.keys.where(self.keys.notna(), None).values.tolist(),
+                       'days': [str(day.date()) for day in self.days]}, handle)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+
+        with open(os.path.join(directory, 'index.json')) as handle:
+            index = json.load(handle)
+
+        return cls(index['level'], pd.DataFrame(index['keys'], columns=index['key_columns']),
+                   pd.DatetimeIndex(index['days']),
+                   *[np.load(os.path.join(directory, name+'.npy'), mmap_mode=mmap_mode)
+                     for name in cls.arrays])
+
+    def window(self, from_date, to_date, reducer='peak'):
+        """
+        Computes the grouped features of the given period: for every entity the 2-week
+        bucket of peak (rounded mean) stringency of its OxCGRT row, its value and the
+        mobility means of the entity in that bucket, Saturdays excluded. Other
+        stringency reducers are applied as in utils.DataPreProcessor.group_data.
+        """
+
+        columns = self.keys.columns.tolist()+['2weeks', 'stringency_value']+utils.MOBILITY_COLUMNS
+
+        low = self.days.searchsorted(pd.Timestamp(from_date), side='left')
+        high = self.days.searchsorted(pd.Timestamp(to_date), side='right')
+        if low >= high:
+            return pd.DataFrame(columns=columns)
+
+        iso = self.days[low:high].isocalendar()
+        week_codes, week_keys = pd.factorize(iso['year'].to_numpy(dtype='int64')*100
+                                             +iso['week'].to_numpy(dtype='int64'))
+        bucket_labels, _ = utils.DataPreProcessor.pair_weeks([(int(key%100), int(key//100))
+                                                              for key in week_keys])
+        buckets = week_codes//2
+        n_entities, n_buckets = len(self.keys), len(bucket_labels)
+
+        day_buckets = np.full(len(self.days), -1, dtype='int64')
+        day_buckets[low:high] = np.where(iso['day'].to_numpy() != 6, buckets, -1)
+        row_buckets = day_buckets[self.day_codes]
+        selected = row_buckets >= 0
+        flat = self.entity_codes[selected].astype('int64')*n_buckets+row_buckets[selected]
+
+        sums, counts, rows = utils.group_sums(flat, self.values[selected].astype('float64'),
+                                              n_entities*n_buckets)
+        sums, counts, rows = [utils.with_total(array.reshape((n_entities, n_buckets)+array.shape[1:]))
+                              for array in (sums, counts, rows)]
+
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        stringency = self.stringency[:, low:high]
+        present = ~np.isnan(stringency)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.add.reduceat(np.where(present, stringency, 0), starts, axis=1, dtype='float64')\
+                /np.add.reduceat(present, starts, axis=1)
+            mobility = sums/counts
+
+        row_bucket, row_value = utils.reduce_buckets(means, bucket_labels, reducer)
+
+        entities = np.flatnonzero(self.entity_stringency >= 0)
+        paired = self.entity_stringency[entities]
+        bucket = row_bucket[paired]
+        selected = np.isfinite(row_value[paired])&(rows[entities, bucket] > 0)
+        entities, paired, bucket = entities[selected], paired[selected], bucket[selected]
+
+        data_final = self.keys.iloc[entities].reset_index(drop=True)
+        data_final['2weeks'] = [(bucket_labels+['all'])[code] for code in bucket]
+        data_final['stringency_value'] = row_value[paired].astype('uint8')
+        data_final[utils.MOBILITY_COLUMNS] = np.nan_to_num(mobility[entities, bucket], nan=0.0)
+
+        return data_final[columns]
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service answering cluster and time series queries from the preprocessed
+data kept in memory.
+
+@author: Anna Davy
+"""
+import sys
+import json
+import asyncio
+import hashlib
+import argparse
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import pandas as pd
+import utils
+import clustering
+
+
+HOST = '127.0.0.1'
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          500: 'Internal Server Error'}
+
+
+class ResultCache:
+    """
+    Bounded cache of query results evicting the least recently used entry.
+
+    Attributes:
+        maxsize (int): Number of results kept.
+        hits, misses (int): Lookups answered and not answered by the cache.
+    """
+
+    def __init__(self, maxsize=256):
+
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+
+        return self.entries[key]
+
+    def put(self, key, value):
+
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses}
+
+
+class QueryService:
+    """
+    Keeps the utils.PrefixIndex of the input files resident and answers queries on it
+    over HTTP on localhost:
+
+    - `/clusters?from=YYYY-MM-DD&to=YYYY-MM-DD&k=4[&reducer=peak]`: the grouped data of
+      the window with the cluster label of every country ('group');
+    - `/series?country=<name>[&from=&to=]`: the mean stringency and mobility of one
+      country in every 2-week bucket of the period;
+    - `/status`: the data version, dates, countries and cache statistics.
+
+    Missing dates default to the first and last dates of the data and dates are
+    clipped to them. Requests are served by an asyncio loop; the KMeans fits run in
+    a process pool whose workers map the index read-only, as in
+    clustering.ClusteringEngine. Cluster results are kept in a ResultCache keyed by
+    window, k, reducer and data version, and concurrent identical queries share one
+    fit. The data version is derived from the fingerprints of the input files, which
+    are checked on every request: when a file changes the index is rebuilt (or
+    loaded from the cache directory) without blocking the loop, and the cached
+    results of the previous version are no longer returned.
+
+    Attributes:
+        mobility_file, stringency_file (str): The input files.
+        cache_dir (str): utils.FileCache directory of the parsed frames and the index.
+        workers (int): Number of fitting processes, all cores by default.
+        random_state (int): Seed of the clustering models.
+        standardise (bool): If True, features are standardised before clustering.
+        results (ResultCache): Cached cluster results.
+
+    Example:
+    ```
+    python service.py --port 8050
+    curl 'http://127.0.0.1:8050/clusters?from=2020-03-01&to=2020-06-30&k=4'
+    ```
+    """
+
+    def __init__(self, mobility_file, stringency_file, cache_dir='.mobility_cache', workers=None,
+                 random_state=None, standardise=False, cache_size=256):
+
+        self.mobility_file = mobility_file
+        self.stringency_file = stringency_file
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.random_state = random_state
+        self.standardise = standardise
+        self.results = ResultCache(cache_size)
+        self.pending = {}
+        self.version = None
+        self.index = None
+        self.pool = None
+        self.shared = None
+        self.lock = None
+
+    def data_version(self):
+        """Returns the version of the input files (size, modification time and content hash)."""
+
+        cache = utils.FileCache(self.cache_dir)
+        payload = json.dumps([cache.fingerprint(self.mobility_file),
+                              cache.fingerprint(self.stringency_file)])
+
+        return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+    def load(self):
+        """Builds or loads the index of the current files and the worker pool sharing it."""
+
+        version = self.data_version()
+        index = utils.PrefixIndex.cached(self.mobility_file, self.stringency_file, self.cache_dir)
+
+        shared = tempfile.TemporaryDirectory()
+        index.save(shared.name)
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=clustering._attach,
+                                   initargs=(shared.name, utils.PrefixIndex))
+
+        return version, index, pool, shared
+
+    async def refresh(self):
+        """Reloads the data when the input files have changed since the last request."""
+
+        loop = asyncio.get_running_loop()
+
+        async with self.lock:
+            version = await loop.run_in_executor(None, self.data_version)
+            if version == self.version:
+                return
+
+            loaded = await loop.run_in_executor(None, self.load)
+            previous = (self.pool, self.shared)
+            self.version, self.index, self.pool, self.shared = loaded
+
+        if previous[0] is not None:
+            previous[0].shutdown(wait=False)
+            previous[1].cleanup()
+
+    def period(self, query):
+        """Returns the 'from' and 'to' dates of the query clipped to the data."""
+
+        first_date, last_date = self.index.days[0].date(), self.index.days[-1].date()
+        from_date = date.fromisoformat(query['from']) if query.get('from') else first_date
+        to_date = date.fromisoformat(query['to']) if query.get('to') else last_date
+
+        return max(from_date, first_date), min(to_date, last_date)
+
+    async def clusters(self, query):
+
+        from_date, to_date = self.period(query)
+        n_clusters = int(query.get('k', 4))
+        reducer = query.get('reducer', 'peak')
+        if n_clusters < 1:
+            raise ValueError('k must be a positive integer')
+        if reducer not in utils.STRINGENCY_REDUCERS:
+            raise ValueError('reducer must be one of '+', '.join(utils.STRINGENCY_REDUCERS))
+
+        key = (str(from_date), str(to_date), n_clusters, reducer, self.version)
+        payload = self.results.get(key)
+        cached = payload is not None
+
+        if not cached:
+            if key not in self.pending:
+                self.pending[key] = asyncio.ensure_future(self.fit(key, from_date, to_date,
+                                                                   n_clusters, reducer))
+            try:
+                payload = await asyncio.shield(self.pending[key])
+            finally:
+                self.pending.pop(key, None)
+
+        return dict(payload, cached=cached)
+
+    async def fit(self, key, from_date, to_date, n_clusters, reducer):
+
+        data_final = await asyncio.get_running_loop().run_in_executor(
+            self.pool, clustering._cluster_shared, from_date, to_date, n_clusters,
+            self.random_state, self.standardise, reducer)
+
+        if data_final is None:
+            rows = []
+        else:
+            rows = json.loads(data_final.drop(columns=['from_date', 'to_date', 'k'])
+                              .to_json(orient='records'))
+
+        # the data may be reloaded during the fit; the payload keeps the version it was fitted on
+        payload = {'from': str(from_date), 'to': str(to_date), 'k': n_clusters, 'reducer': reducer,
+                   'version': key[-1], 'rows': rows}
+        self.results.put(key, payload)
+
+        return payload
+
+    def series(self, query):
+
+        if query.get('country') not in self.index.countries:
+            raise LookupError('unknown country: '+str(query.get('country')))
+
+        from_date, to_date = self.period(query)
+        position = self.index.countries.index(query['country'])
+        bucket_labels, _, _, sums, counts, _, means = self.index.bucket_totals(from_date, to_date)
+
+        rows = []
+        if len(bucket_labels) > 0:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frame = pd.DataFrame(sums[position]/counts[position], columns=utils.MOBILITY_COLUMNS)
+            frame.insert(0, 'stringency_value', means[position])
+            frame.insert(0, '2weeks', bucket_labels)
+            rows = json.loads(frame.to_json(orient='records'))
+
+        return {'country': query['country'], 'from': str(from_date), 'to': str(to_date),
+                'version': self.version, 'rows': rows}
+
+    def status(self, query):
+
+        return {'version': self.version, 'first_date': str(self.index.days[0].date()),
+                'last_date': str(self.index.days[-1].date()), 'countries': self.index.countries,
+                'cache': self.results.stats()}
+
+    async def respond(self, method, target):
+        """Returns the status code and JSON payload of one request."""
+
+        if method != 'GET':
+            return 405, {'error': 'only GET requests are served'}
+
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        routes = {'/clusters': self.clusters, '/series': self.series, '/status': self.status}
+
+        if url.path not in routes:
+            return 404, {'error': 'unknown path '+url.path, 'paths': list(routes)}
+
+        try:
+            await self.refresh()
+            payload = routes[url.path](query)
+            if asyncio.iscoroutine(payload):
+                payload = await payload
+        except LookupError as error:
+            return 404, {'error': str(error.args[0])}
+        except ValueError as error:
+            return 400, {'error': str(error)}
+
+        return 200, payload
+
+    async def handle(self, reader, writer):
+
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()).strip():
+                pass
+
+            if len(request) < 2:
+                code, payload = 400, {'error': 'malformed request'}
+            else:
+                try:
+                    code, payload = await self.respond(request[0], request[1])
+                except Exception as error:
+                    code, payload = 500, {'error': type(error).__name__+': '+str(error)}
+
+            body = json.dumps(payload).encode()
+            writer.write(('HTTP/1.1 '+str(code)+' '+STATUS[code]+'\r\n'
+                          'Content-Type: application/json\r\n'
+                          'Content-Length: '+str(len(body))+'\r\n'
+                          'Connection: close\r\n\r\n').encode()+body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port=8050):
+        """Loads the data and serves requests on localhost until cancelled."""
+
+        self.lock = asyncio.Lock()
+        await self.refresh()
+
+        server = await asyncio.start_server(self.handle, HOST, port)
+        print('Serving '+str(len(self.index.countries))+' countries on http://'+HOST+':'+str(port))
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown()
+            self.shared.cleanup()
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Local query service for country groups.')
+    parser.add_argument('--mobility', default='Global_Mobility_Report.csv')
+    parser.add_argument('--stringency', default='OxCGRT_timeseries_all.xlsx')
+    parser.add_argument('--cache-dir', default='.mobility_cache')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of fitting processes, all cores by default')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='number of cluster results kept in memory')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--standardise', action='store_true')
+
+    args = parser.parse_args(argv)
+
+    service = QueryService(args.mobility, args.stringency, args.cache_dir, args.workers,
+                           args.seed, args.standardise, args.cache_size)
+    try:
+        asyncio.run(service.serve(args.port))
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
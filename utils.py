@@ -6,19 +6,449 @@ Created on Fri Dec  4 10:46:25 2020
 """
 import pandas as pd
 import numpy as np
+from pandas.api.types import union_categoricals
 import sys
-import tkinter as tk
-from tkinter import messagebox
+import os
+import re
+import shutil
+import zipfile
+import json
+import hashlib
+import time
 import warnings
-warnings.filterwarnings("ignore")
+import cProfile
+import functools
+import tracemalloc
+import importlib.util
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, date
-from tkinter import ttk
-from tkcalendar import Calendar
 from datetime import datetime as second_datetime
-import dateparser
 
 
 
+MOBILITY_COLUMNS=['retail_and_recreation_percent_change_from_baseline',
+                  'grocery_and_pharmacy_percent_change_from_baseline',
+                  'parks_percent_change_from_baseline',
+                  'transit_stations_percent_change_from_baseline',
+                  'workplaces_percent_change_from_baseline',
+                  'residential_percent_change_from_baseline']
+
+REGION_COLUMNS=['country_region','sub_region_1','sub_region_2','metro_area']
+
+REGION_LEVELS=('country','sub_region_1','sub_region_2','metro_area')
+
+# members of Region_Mobility_Report_CSVs.zip: <year>_<country code>_Region_Mobility_Report.csv
+ARCHIVE_MEMBER=re.compile(r'(?:.*/)?(\d{4})_([^_/]+)_Region_Mobility_Report\.csv$')
+
+OXCGRT_KEYS=['CountryName','CountryCode','RegionName','RegionCode','CityName','CityCode','Jurisdiction']
+
+# python-calamine parses xlsx files much faster than openpyxl and is used when installed
+EXCEL_ENGINE='calamine' if importlib.util.find_spec('python_calamine') else None
+
+STRINGENCY_REDUCERS=('peak','mean','median','last')
+
+OUTPUT_FORMATS={'xlsx':'.xlsx','parquet':'.parquet','arrow':'.arrow','csv':'.csv'}
+
+# words of the result names shortened in sheet names longer than Excel allows
+SHEET_ABBREVIATIONS={'temporal_labels':'tl','temporal_transitions':'tt','k_selection':'ks',
+                     'stringency_index':'si','government_response_index':'gri',
+                     'containment_health_index':'chi','economic_support_index':'esi'}
+
+_report=None
+
+
+def memory_status():
+    """
+    Returns the current and peak resident set size in MB from /proc/self/status
+    ('VmRSS', 'VmHWM'), or None where it is not available (outside Linux).
+    """
+    
+    try:
+        with open('/proc/self/status') as handle:
+            fields=dict(line.split(':',1) for line in handle if line.startswith(('VmRSS','VmHWM')))
+    except OSError:
+        return None
+    
+    if len(fields)<2:
+        return None
+    
+    return {name:int(value.split()[0])/2**10 for name,value in fields.items()}
+
+
+def reset_peak_rss():
+    """Resets the VmHWM peak of the process (Linux); returns False if it cannot be reset."""
+    
+    try:
+        with open('/proc/self/clear_refs','w') as handle:
+            handle.write('5')
+    except OSError:
+        return False
+    
+    return True
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of the process so far in MB, None if unknown."""
+    
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory=psutil.Process().memory_info()
+        return getattr(memory,'peak_wset',memory.rss)/2**20
+    
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    return peak/2**20 if sys.platform=='darwin' else peak/2**10
+
+
+def frame_shapes(value):
+    """Returns [rows, columns] of every data frame or matrix in `value` (or in a tuple/list of values)."""
+    
+    values=value if isinstance(value,(tuple,list)) else [value]
+    
+    return [[int(size) for size in item.shape] for item in values
+            if isinstance(item,(pd.DataFrame,np.ndarray)) and item.ndim==2]
+
+
+class RunReport:
+    """
+    Collects per-stage measurements of a pipeline run and writes them as JSON.
+
+    While a RunReport is active (used as a context manager), every method decorated
+    with `instrumented` records a stage: wall time, CPU time, the resident set size
+    at its start and end and its peak during the stage ('rss_start_mb', 'rss_end_mb',
+    'peak_rss_mb'), the all-time peak of the process at its end
+    ('process_peak_rss_mb') and the rows and columns of the frames it returned.
+    The per-stage peak relies on resetting the Linux VmHWM counter; elsewhere the
+    RSS fields of the stage are None and only the process peak is recorded.
+    Optionally each top-level stage is profiled with cProfile and the traced peak
+    memory of each stage is recorded with tracemalloc. Stages run inside another
+    stage are recorded with their depth but not profiled separately.
+
+    Attributes:
+        profile (bool): If True, stages are profiled and the statistics are written
+            next to the report as '<report>_<stage>.prof'.
+        trace_memory (bool): If True, tracemalloc runs during the report and the
+            traced peak of every stage is recorded (this slows the run down).
+        stages (list): The recorded stages in order of completion.
+
+    Example:
+    ```
+    with RunReport() as report:
+        data,stringency = DataReader(...).read()
+        ...
+    report.write('results/run_report.json')
+    ```
+    """
+    
+    def __init__(self,profile=False,trace_memory=False):
+        
+        self.profile=profile
+        self.trace_memory=trace_memory
+        self.stages=[]
+        self.profiles={}
+        self.depth=0
+        self.started=second_datetime.now()
+        # running RSS peaks of the open stages and of the process, as every stage
+        # resets the counter (and with it ru_maxrss)
+        self.rss_peaks=[]
+        self.process_peak=0
+        
+    def __enter__(self):
+        
+        global _report
+        
+        self.previous=_report
+        _report=self
+        if self.trace_memory:
+            tracemalloc.start()
+            
+        return self
+    
+    def __exit__(self,*exc_info):
+        
+        global _report
+        
+        _report=self.previous
+        if self.trace_memory:
+            tracemalloc.stop()
+            
+    @contextmanager
+    def stage(self,name):
+        
+        record={'stage':name,'depth':self.depth}
+        profiler=cProfile.Profile() if self.profile and self.depth==0 else None
+        
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        memory=memory_status()
+        tracked=memory is not None and reset_peak_rss()
+        if tracked:
+            record['rss_start_mb']=memory['VmRSS']
+            self.process_peak=max(self.process_peak,memory['VmHWM'])
+            self.rss_peaks=[max(peak,memory['VmHWM']) for peak in self.rss_peaks]
+            self.rss_peaks.append(memory['VmRSS'])
+        self.depth+=1
+        wall,cpu=time.perf_counter(),time.process_time()
+        if profiler is not None:
+            profiler.enable()
+            
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiles.setdefault(name,[]).append(profiler)
+            self.depth-=1
+            record['wall_seconds']=time.perf_counter()-wall
+            record['cpu_seconds']=time.process_time()-cpu
+            memory=memory_status() if tracked else None
+            if memory is not None:
+                peak=max(self.rss_peaks.pop(),memory['VmHWM'])
+                if self.rss_peaks:
+                    self.rss_peaks[-1]=max(self.rss_peaks[-1],peak)
+                self.process_peak=max(self.process_peak,peak)
+                record['rss_end_mb']=memory['VmRSS']
+                record['peak_rss_mb']=peak
+                record['process_peak_rss_mb']=self.process_peak
+            else:
+                record['rss_start_mb']=record['rss_end_mb']=record['peak_rss_mb']=None
+                record['process_peak_rss_mb']=peak_rss_mb()
+            if self.trace_memory:
+                record['traced_peak_mb']=tracemalloc.get_traced_memory()[1]/2**20
+            self.stages.append(record)
+            
+    def write(self,path):
+        
+        import pstats
+        
+        folder=os.path.dirname(path)
+        if folder:
+            os.makedirs(folder,exist_ok=True)
+            
+        with open(path,'w') as handle:
+            json.dump({'started':self.started.isoformat(timespec='seconds'),
+                       'python':sys.version.split()[0],'pandas':pd.__version__,
+                       'numpy':np.__version__,'stages':self.stages},handle,indent=2)
+            
+        for name,profilers in self.profiles.items():
+            statistics=pstats.Stats(*profilers)
+            statistics.dump_stats(os.path.splitext(path)[0]+'_'+name+'.prof')
+            
+        return path
+    
+    
+def instrumented(name,frames=None):
+    """
+    Decorator recording a call as stage `name` of the active RunReport, if any. The
+    shapes are taken from the returned frames, or from `frames(self)` when given.
+    """
+    
+    def decorate(method):
+        
+        @functools.wraps(method)
+        def wrapper(*args,**kwargs):
+            
+            if _report is None:
+                return method(*args,**kwargs)
+            
+            with _report.stage(name) as record:
+                result=method(*args,**kwargs)
+                record['shapes']=frame_shapes(frames(args[0]) if frames is not None else result)
+                
+            return result
+        
+        return wrapper
+    
+    return decorate
+
+
+class FileCache:
+    """
+    An on-disk columnar cache of parsed input frames.
+
+    Frames are stored as uncompressed Feather (Arrow IPC) files so that later runs
+    can map them back into memory instead of parsing the source again. Each entry
+    is keyed by the source file's absolute path, size, modification time and
+    content hash, together with the reader options that shaped the frame. The
+    content hash is kept in a manifest and only recomputed when the size or
+    modification time of the source changes; entries of a changed source are
+    removed when the new frame is stored. Frames parsed from a member of a zip
+    archive are keyed by the member's CRC and size instead (`member_key`), so they
+    stay valid when other members of the archive change.
+
+    Attributes:
+        cache_dir (str): Directory holding the cached frames and the manifest.
+    """
+    
+    def __init__(self,cache_dir):
+        
+        self.cache_dir=cache_dir
+        os.makedirs(self.cache_dir,exist_ok=True)
+        self.manifest_path=os.path.join(self.cache_dir,'manifest.json')
+        
+        try:
+            with open(self.manifest_path) as handle:
+                self.manifest=json.load(handle)
+        except (OSError,ValueError):
+            self.manifest={}
+            
+    @staticmethod
+    def content_hash(file,block_size=1<<23):
+        
+        digest=hashlib.blake2b(digest_size=16)
+        with open(file,'rb') as handle:
+            for block in iter(lambda: handle.read(block_size),b''):
+                digest.update(block)
+                
+        return digest.hexdigest()
+    
+    def fingerprint(self,file):
+        
+        path=os.path.abspath(file)
+        stat=os.stat(path)
+        entry=self.manifest.get(path)
+        
+        if entry is None or entry['size']!=stat.st_size or entry['mtime_ns']!=stat.st_mtime_ns:
+            stale=entry['keys'] if entry is not None else []
+            entry={'size':stat.st_size,'mtime_ns':stat.st_mtime_ns,
+                   'hash':self.content_hash(path),'keys':[]}
+            for key in stale:
+                self._remove(key)
+            self.manifest[path]=entry
+            self._save_manifest()
+            
+        return [path,entry['size'],entry['mtime_ns'],entry['hash']]
+    
+    def key(self,file,**options):
+        
+        payload=json.dumps([self.fingerprint(file),options],sort_keys=True,default=str)
+        
+        return hashlib.blake2b(payload.encode(),digest_size=16).hexdigest()
+    
+    @staticmethod
+    def member_path(file,member):
+        
+        return os.path.abspath(file)+'!'+member.filename
+    
+    def member_key(self,file,member,**options):
+        """Like `key` for a member (ZipInfo) of the zip archive `file`."""
+        
+        path=self.member_path(file,member)
+        entry=self.manifest.get(path)
+        
+        if entry is None or entry['size']!=member.file_size or entry['crc']!=member.CRC:
+            stale=entry['keys'] if entry is not None else []
+            entry={'size':member.file_size,'crc':member.CRC,'keys':[]}
+            for key in stale:
+                self._remove(key)
+            self.manifest[path]=entry
+            self._save_manifest()
+            
+        payload=json.dumps([path,entry['size'],entry['crc'],options],sort_keys=True,default=str)
+        
+        return hashlib.blake2b(payload.encode(),digest_size=16).hexdigest()
+    
+    def path(self,key,extension='.feather'):
+        
+        return os.path.join(self.cache_dir,key+extension)
+    
+    def load(self,key):
+        
+        from pyarrow import feather
+        
+        path=self.path(key)
+        if not os.path.exists(path):
+            return None
+        
+        return feather.read_table(path,memory_map=True).to_pandas()
+    
+    def store(self,key,file,frame):
+        
+        path=self.path(key)
+        frame=frame.reset_index(drop=True)
+        frame.columns=frame.columns.astype(str)
+        frame.to_feather(path+'.tmp',compression='uncompressed')
+        os.replace(path+'.tmp',path)
+        self.register(key,file)
+        
+        return frame
+    
+    def register(self,key,file):
+        """Records an entry written to `path(key, ...)` as derived from `file`."""
+        
+        entry=self.manifest[os.path.abspath(file)]
+        if key not in entry['keys']:
+            entry['keys'].append(key)
+        self._save_manifest()
+    
+    def _remove(self,key):
+        
+        for extension in ('.feather','.parquet'):
+            try:
+                os.remove(self.path(key,extension))
+            except OSError:
+                pass
+        shutil.rmtree(self.path(key,'.index'),ignore_errors=True)
+        
+    def _save_manifest(self):
+        
+        with open(self.manifest_path+'.tmp','w') as handle:
+            json.dump(self.manifest,handle)
+        os.replace(self.manifest_path+'.tmp',self.manifest_path)
+        
+
+def indicator_key(name):
+    """
+    Normalises an OxCGRT indicator, sheet or column name for matching, e.g.
+    'stringency_index' and 'StringencyIndex_Average' both give 'stringencyindex'.
+    """
+    
+    key=re.sub('[^0-9a-z]','',str(name).lower())
+    
+    return key[:-len('average')] if key.endswith('average') else key
+
+
+def is_index_indicator(name):
+    """
+    Tells whether an indicator is one of the 0-100 OxCGRT indices (stringency,
+    government response, containment and health, economic support), the only
+    values that fit the uint8 'stringency_value' of the grouped data; case and
+    death counts or the fiscal amounts of E3/E4/H4/H5 do not.
+    """
+    
+    return 'index' in indicator_key(name)
+
+
+def is_wide_oxcgrt(file):
+    """
+    Tells whether an OxCGRT CSV is in the wide layout (one row per country, one
+    column per date), which holds a single indicator that the file does not name.
+    """
+    
+    if not file.endswith('.csv'):
+        return False
+    
+    return not any(indicator_key(column)=='date' for column in pd.read_csv(file,nrows=0).columns)
+
+
+def read_sheet(file,sheet_name):
+    
+    return pd.read_excel(file,sheet_name=sheet_name,engine=EXCEL_ENGINE)
+
+
+def read_archive_member(reader,file,member):
+    """Streams one member of a mobility zip archive through `reader.read_mobility`."""
+    
+    with zipfile.ZipFile(file) as archive, archive.open(member) as handle:
+        return reader.read_mobility(handle)
+
+
 class DataReader:
     """
     A class to read data from different file formats.
@@ -29,22 +459,435 @@ class DataReader:
 
     Attributes:
         files (tuple): A tuple containing file paths provided during class instantiation.
+        streaming (bool): If True, the mobility CSV is read in chunks keeping only the
+            columns used by the pipeline, stored with compact dtypes.
+        chunksize (int): Number of CSV rows parsed per chunk in streaming mode.
+        level (str): Aggregation level kept while streaming ('country', 'sub_region_1',
+            'sub_region_2', 'metro_area'); None keeps the rows of every level.
+        from_date, to_date (date): Optional date range applied while streaming.
+        cache (FileCache): Columnar cache of the parsed frames, used when a `cache_dir`
+            is given.
+        indicators (list): OxCGRT indices to read ('stringency_index',
+            'containment_health_index', ...; see `is_index_indicator`); by default the first sheet of a workbook
+            or the stringency index of a CSV. The first one is returned by `read`, all
+            of them are kept in `indicator_sheets`.
+        workers (int): Number of processes parsing workbook sheets or archive members,
+            all cores by default.
+        countries (list): Optional ISO codes ('country_region_code') of the countries
+            kept from the mobility data.
+
+    The OxCGRT data may be the timeseries workbook, a wide timeseries CSV (one
+    indicator, one column per day) or a long CSV (one row per country and day, as in
+    the OxCGRT national and compact releases). Every indicator is returned in the
+    wide layout of the workbook sheets; CSV files are told apart from the mobility
+    report by their header.
+
+    The mobility data may also be Google's Region_Mobility_Report_CSVs.zip, read
+    without extracting it (see `read_archive`).
     """
     
-    def __init__(self,*files):
+    def __init__(self,*files,streaming=False,chunksize=500000,level=None,
+                 from_date=None,to_date=None,cache_dir=None,indicators=None,workers=None,
+                 countries=None):
+        
+        if level is not None and level not in REGION_LEVELS:
+            raise ValueError("level must be one of "+str(REGION_LEVELS))
+        
+        unsupported=[name for name in indicators or [] 
+                     if not isinstance(name,int) and not is_index_indicator(name)]
+        if unsupported:
+            raise ValueError("only the 0-100 OxCGRT indices can be used as stringency, not: "
+                             +', '.join(map(str,unsupported)))
         
         self.files=(files)
+        self.streaming=streaming
+        self.chunksize=chunksize
+        self.level=level
+        self.from_date=from_date
+        self.to_date=to_date
+        self.cache=FileCache(cache_dir) if cache_dir is not None else None
+        self.indicators=indicators
+        self.workers=workers
+        self.countries=countries
+        self.indicator_sheets={}
         
+    @instrumented('read')
     def read(self):
         
+        data,stringency=None,None
+        
         for file in self.files:
             
-            if file.endswith('.csv'):
-                data= pd.read_csv(file)
-            elif file.endswith('.xlsx'):
-                stringency=pd.read_excel(file)
+            if file.endswith('.xlsx') or (file.endswith('.csv') and 'country_region' 
+                                          not in pd.read_csv(file,nrows=0).columns):
+                self.indicator_sheets=self.read_oxcgrt(file)
+                stringency=next(iter(self.indicator_sheets.values()))
+            elif file.endswith('.zip'):
+                data=self.read_archive(file)
+            elif file.endswith('.csv'):
+                if self.streaming:
+                    data=self._cached(file,self.read_mobility,streaming=True,
+                                      level=self.level,from_date=self.from_date,
+                                      to_date=self.to_date,countries=self.countries)
+                else:
+                    data=self._cached(file,pd.read_csv)
+                
+        return data,stringency
+    
+    def read_oxcgrt(self,file):
+        """
+        Reads the requested OxCGRT indicators of a workbook, wide CSV or long CSV.
+        A wide CSV holds one indicator, taken to be the requested one.
+
+        Returns:
+            a dictionary of indicator -> wide frame in the order requested (keyed 0
+            for the first sheet of a workbook read by default)
+        """
+        
+        if file.endswith('.xlsx'):
+            return self._cached_indicators(file,self.indicators or [0],self.read_sheets)
+        
+        if is_wide_oxcgrt(file):
+            if self.indicators and len(self.indicators)>1:
+                raise ValueError("a wide OxCGRT CSV holds a single indicator, not "
+                                 +', '.join(map(str,self.indicators))+": "+file)
+            return {(self.indicators or ['stringency_index'])[0]:self._cached(file,pd.read_csv)}
+        
+        return self._cached_indicators(file,self.indicators or ['stringency_index'],self.read_long)
+    
+    @staticmethod
+    def match_indicators(available,names):
+        """Returns the sheet or column of every requested indicator (sheet numbers are kept)."""
+        
+        keys={}
+        for column in available:
+            keys.setdefault(indicator_key(column),column)
+            
+        missing=[name for name in names if not isinstance(name,int) and indicator_key(name) not in keys]
+        if missing:
+            raise ValueError("OxCGRT indicators not found: "+', '.join(map(str,missing))
+                             +"; available: "+', '.join(map(str,available)))
+            
+        return [name if isinstance(name,int) else keys[indicator_key(name)] for name in names]
+    
+    def read_sheets(self,file,names):
+        """
+        Parses the workbook sheets of the given indicators, each in its own process
+        when there are several, so the sheets are not parsed one after the other.
+        """
+        
+        if all(isinstance(name,int) for name in names):
+            sheets=list(names)
+        else:
+            with pd.ExcelFile(file,engine=EXCEL_ENGINE) as workbook:
+                sheets=self.match_indicators(workbook.sheet_names,names)
+                
+        workers=min(self.workers or os.cpu_count(),len(sheets))
+        if workers<=1:
+            frames=[read_sheet(file,sheet) for sheet in sheets]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                frames=list(pool.map(read_sheet,[file]*len(sheets),sheets))
+                
+        return dict(zip(names,frames))
+    
+    def read_long(self,file,names):
+        """
+        Reads the given indicators of a long OxCGRT CSV in one pass over the needed
+        columns and spreads each into the wide layout: the key columns of every
+        country or region followed by one column per day ('%Y-%m-%d').
+        """
+        
+        header=pd.read_csv(file,nrows=0).columns
+        indicator_columns=self.match_indicators(header,names)
+        key_columns=[column for column in header if column in OXCGRT_KEYS]
+        date_column=[column for column in header if indicator_key(column)=='date'][0]
+        
+        frame=pd.read_csv(file,usecols=key_columns+[date_column]+indicator_columns,
+                          dtype={**dict.fromkeys(key_columns,'object'),date_column:'str'})
+        frame=frame[frame[date_column].notna()]
+        
+        # dates are parsed once per unique value ('20200101' in the OxCGRT releases)
+        date_codes,unique_dates=pd.factorize(frame[date_column])
+        days=pd.to_datetime(unique_dates,format='%Y%m%d',errors='coerce')
+        if days.isna().any():
+            days=days.where(days.notna(),DataPreProcessor.parse_dates(np.asarray(unique_dates,dtype=object)))
+        order=np.argsort(np.asarray(days),kind='stable')
+        day_codes=np.empty(len(days),dtype='int64')
+        day_codes[order]=np.arange(len(days))
+        day_codes=day_codes[date_codes]
+        
+        row_codes=frame.groupby(key_columns,sort=False,dropna=False).ngroup().to_numpy()
+        first=np.unique(row_codes,return_index=True)[1]
+        keys=frame[key_columns].iloc[first].reset_index(drop=True)
+        headers=[day.strftime('%Y-%m-%d') if not pd.isna(day) else str(value) 
+                 for day,value in zip(days[order],unique_dates[order])]
+        
+        sheets={}
+        for name,column in zip(names,indicator_columns):
+            values=np.full((len(keys),len(headers)),np.nan)
+            values[row_codes,day_codes]=frame[column].to_numpy(dtype='float64')
+            sheets[name]=pd.concat([keys,pd.DataFrame(values,columns=headers)],axis=1)
+            
+        return sheets
+    
+    def _cached_indicators(self,file,names,loader):
+        """
+        Like `_cached` for loaders returning a frame per indicator: every indicator is
+        cached on its own and only the missing ones are loaded.
+        """
+        
+        if self.cache is None:
+            return loader(file,names)
+        
+        keys={name:self.cache.key(file,indicator=name) for name in names}
+        frames={name:self.cache.load(keys[name]) for name in names}
+        missing=[name for name in names if frames[name] is None]
+        
+        if missing:
+            for name,frame in loader(file,missing).items():
+                frames[name]=self.cache.store(keys[name],file,frame)
+                
+        return frames
+    
+    def _cached(self,file,loader,**options):
+        
+        if self.cache is None:
+            return loader(file)
+        
+        key=self.cache.key(file,**options)
+        frame=self.cache.load(key)
+        if frame is None:
+            frame=self.cache.store(key,file,loader(file))
+            
+        return frame
+    
+    def _level_mask(self,chunk):
+        
+        if self.level is None:
+            return pd.Series(True,index=chunk.index)
+        
+        target=REGION_LEVELS.index(self.level)
+        mask=pd.Series(True,index=chunk.index)
+        for position,level_column in enumerate(REGION_COLUMNS[1:],start=1):
+            if level_column not in chunk.columns:
+                continue
+            if position==target:
+                mask&=chunk[level_column].notna()
+            elif position>target or level_column=='metro_area':
+                mask&=chunk[level_column].isna()
                 
-        return data,stringency     
+        return mask
+    
+    def read_mobility(self,file):
+        """
+        Streams the Google mobility CSV in chunks of `chunksize` rows.
+
+        Only the region, date and percent change columns are parsed; rows outside
+        the requested aggregation level and date range are dropped chunk by chunk,
+        so peak memory follows the size of the selection rather than the raw file.
+        Region keys and dates are stored as categoricals, percent changes as float32.
+        """
+        
+        key_columns=REGION_COLUMNS[:(REGION_LEVELS.index(self.level)+1 
+                                     if self.level is not None else None)]
+        wanted=set(REGION_COLUMNS+['date']+MOBILITY_COLUMNS
+                   +(['country_region_code'] if self.countries is not None else []))
+        dtypes=dict.fromkeys(REGION_COLUMNS+['date'],'object')
+        dtypes.update(dict.fromkeys(MOBILITY_COLUMNS,'float32'))
+        
+        chunks=[]
+        
+        for chunk in pd.read_csv(file,usecols=lambda column: column in wanted,
+                                 dtype=dtypes,chunksize=self.chunksize):
+            
+            mask=self._level_mask(chunk)
+            if self.countries is not None:
+                # Namibia's code 'NA' is parsed as missing
+                mask&=chunk['country_region_code'].fillna('NA').isin(self.countries)
+            if self.from_date is not None:
+                mask&=chunk['date']>=str(self.from_date)
+            if self.to_date is not None:
+                mask&=chunk['date']<=str(self.to_date)
+                
+            chunk=chunk.loc[mask,[column for column in key_columns+['date']+MOBILITY_COLUMNS
+                                   if column in chunk.columns]]
+            for column in chunk.columns.difference(MOBILITY_COLUMNS):
+                chunk[column]=chunk[column].astype('category')
+            chunks.append(chunk)
+            
+        return concat_categorical(chunks)
+    
+    def read_archive(self,file):
+        """
+        Reads the per-country, per-year CSVs of a Google Region_Mobility_Report_CSVs.zip
+        archive straight from the archive.
+
+        Only the members of the requested `countries` and of the years between
+        `from_date` and `to_date` are opened. Each is streamed like the monolithic
+        CSV (`read_mobility`), the members being parsed in parallel processes, and
+        the frames are concatenated in country and year order into the same compact
+        frame. With a cache every member is cached on its own, keyed by its CRC, so
+        after an update of the archive only the changed members are parsed again.
+        """
+        
+        with zipfile.ZipFile(file) as archive:
+            members=[]
+            for member in archive.infolist():
+                match=ARCHIVE_MEMBER.match(member.filename)
+                if match is None:
+                    continue
+                year,country=int(match.group(1)),match.group(2)
+                if (self.countries is None or country in self.countries) and \
+                   (self.from_date is None or year>=self.from_date.year) and \
+                   (self.to_date is None or year<=self.to_date.year):
+                    members.append(((country,year),member))
+        members=[member for _,member in sorted(members,key=lambda item: item[0])]
+        
+        if not members:
+            years=[str(day.year) if day is not None else '' for day in (self.from_date,self.to_date)]
+            raise ValueError("no member of "+file+" matches the requested countries ("
+                             +(', '.join(self.countries) if self.countries is not None else 'any')
+                             +") and years ("+('-'.join(years) if any(years) else 'any')+")")
+        
+        options=dict(level=self.level,from_date=self.from_date,to_date=self.to_date,
+                     countries=self.countries)
+        keys=[self.cache.member_key(file,member,**options) if self.cache is not None else None
+              for member in members]
+        frames=[self.cache.load(key) if key is not None else None for key in keys]
+        missing=[position for position,frame in enumerate(frames) if frame is None]
+        
+        # a reader without cache (picklable and small) parses the members
+        reader=DataReader(chunksize=self.chunksize,**options)
+        workers=min(self.workers or os.cpu_count(),len(missing))
+        if workers<=1:
+            parsed=[read_archive_member(reader,file,members[position].filename) for position in missing]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parsed=list(pool.map(read_archive_member,[reader]*len(missing),[file]*len(missing),
+                                     [members[position].filename for position in missing]))
+                
+        for position,frame in zip(missing,parsed):
+            if self.cache is not None:
+                frame=self.cache.store(keys[position],self.cache.member_path(file,members[position]),frame)
+            frames[position]=frame
+            
+        # the columns are kept when every member is empty
+        frames=[frame for frame in frames if len(frame)>0] or frames[:1]
+        for frame in frames:
+            for column in frame.columns.difference(MOBILITY_COLUMNS):
+                frame[column]=frame[column].astype('category')
+                
+        return concat_categorical(frames)
+
+    
+def compact_mobility(data):
+    """
+    Returns the mobility rows reduced to the columns the pipeline uses, with region
+    keys and dates as categoricals and percent changes as float32. Columns that
+    already have these dtypes (as produced by the streaming reader) are not copied.
+    """
+    
+    columns=[column for column in REGION_COLUMNS+['date']+MOBILITY_COLUMNS if column in data.columns]
+    converted={}
+    
+    for column in columns:
+        if column in MOBILITY_COLUMNS:
+            if data[column].dtype!='float32':
+                converted[column]=data[column].astype('float32')
+        elif not isinstance(data[column].dtype,pd.CategoricalDtype):
+            converted[column]=data[column].astype('category')
+            
+    return data[columns].assign(**converted)
+
+
+def concat_categorical(frames):
+    """
+    Concatenates data frames whose categorical columns carry different categories,
+    keeping those columns categorical instead of falling back to object dtype.
+    """
+    
+    if len(frames)==0:
+        return pd.DataFrame()
+    
+    categorical={column:union_categoricals([frame[column] for frame in frames])
+                 for column in frames[0].columns 
+                 if isinstance(frames[0][column].dtype,pd.CategoricalDtype)}
+    
+    data=pd.concat([frame.drop(columns=list(categorical)) for frame in frames],
+                   ignore_index=True)
+    for column in categorical:
+        data[column]=categorical[column]
+        
+    return data[frames[0].columns]
+
+
+def group_sums(codes,values,size):
+    """
+    Sums the rows of `values` (rows x columns, NaN for missing) by integer group code.
+
+    Returns:
+        the sums and the number of non-missing values per group and column, and the
+        number of rows per group
+    """
+    
+    available=~np.isnan(values)
+    sums=np.stack([np.bincount(codes,weights=np.where(available[:,column],values[:,column],0),
+                               minlength=size) for column in range(values.shape[1])],axis=-1)
+    counts=np.stack([np.bincount(codes,weights=available[:,column],minlength=size)
+                     for column in range(values.shape[1])],axis=-1)
+    
+    return sums,counts,np.bincount(codes,minlength=size)
+
+
+def with_total(array):
+    """
+    Appends the sum over the buckets (axis 1) as a last bucket, so that the bucket -1
+    returned by `reduce_buckets` for whole period reducers selects it.
+    """
+    
+    return np.concatenate([array,array.sum(axis=1,keepdims=True)],axis=1)
+
+
+def reduce_buckets(means,bucket_labels,reducer='peak'):
+    """
+    Summarises the 2-week bucket means of stringency (rows x buckets, NaN where a
+    bucket has no values) per row. Every reducer works on the same matrix:
+
+    - 'peak': the highest rounded bucket mean; ties go to the first bucket by label,
+      as in a groupby on the labels
+    - 'last': the rounded mean of the last bucket with values
+    - 'mean', 'median': the rounded mean or median of the bucket means
+
+    Returns:
+        the bucket of every row (-1 when the value covers the whole period) and its
+        value, NaN for rows without any stringency
+    """
+    
+    if reducer not in STRINGENCY_REDUCERS:
+        raise ValueError('reducer must be one of '+', '.join(STRINGENCY_REDUCERS))
+    
+    # the means of two-decimal values are settled to 1e-6 first, so that the order in
+    # which the paths sum them (per day, cumulative) cannot move a .5 across a rounding
+    means=np.round(means,6)
+    
+    if reducer in ('mean','median') or means.shape[1]==0:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning)
+            value=(np.nanmedian if reducer=='median' else np.nanmean)(means,axis=1)
+        return np.full(len(means),-1),np.round(value)
+    
+    missing=np.isnan(means)
+    
+    if reducer=='peak':
+        order=np.argsort(np.array(bucket_labels,dtype=object),kind='stable')
+        ranked=np.where(missing[:,order],-np.inf,np.round(means[:,order]))
+        bucket=order[ranked.argmax(axis=1)]
+    else:
+        bucket=means.shape[1]-1-(~missing[:,::-1]).argmax(axis=1)
+        
+    return bucket,np.round(means[np.arange(len(means)),bucket])
+
     
 class DataPreProcessor:
     """
@@ -74,28 +917,41 @@ class DataPreProcessor:
     Note:
     - The list of countries to be removed and the country renaming dictionary are hardcoded within the class.
     - This class is designed to work with specific data structures and may require modification for different data sets.
+    - The mobility data is kept compact: only the region, date and percent change columns, with categorical
+      keys and dates, float32 percent changes, int16 ISO weeks and years and categorical (integer coded)
+      week and bucket columns. New frames are built with `assign` rather than by writing into filtered views.
+    - The day x country stringency matrix is float64: it is small, and the bucket means must round exactly as
+      those of FeatureCube and PrefixIndex (a float32 mean ending in .5 may round the other way).
     """
     
+    to_be_removed=['Antigua and Barbuda','Aruba','Liechtenstein','North Macedonia',
+                   'Puerto Rico','Réunion','Taiwan']
+    
+    country_dict={'The Bahamas':'Bahamas',"Côte d'Ivoire":"Cote d'Ivoire",
+                  'Czechia':'Czech Republic','Guinea-Bissau':'Guinea',
+                  'Kyrgyzstan':'Kyrgyz Republic','Slovakia':'Slovak Republic'}
+    
     def __init__(self, data, stringency):
         
-        self.data=data
+        self.data=compact_mobility(data)
         self.stringency=stringency
-        
-        to_be_removed=['Antigua and Barbuda','Aruba','Liechtenstein','North Macedonia',
-                       'Puerto Rico','Réunion','Taiwan']
 
-        self.data=self.data[~self.data.country_region.isin(to_be_removed)]
+        kept=self.data[~self.data.country_region.isin(self.to_be_removed)]
 
-        country_dict={'The Bahamas':'Bahamas',"Côte d'Ivoire":"Cote d'Ivoire",
-                      'Czechia':'Czech Republic','Guinea-Bissau':'Guinea',
-                   'Kyrgyzstan':'Kyrgyz Republic','Slovakia':'Slovak Republic'}
-
-        self.data['country_region']=self.data['country_region'].replace(country_dict)
+        countries=kept['country_region'].cat.remove_unused_categories()\
+            .map(lambda name: self.country_dict.get(name,name)).astype('category')
+        
+        self.data=kept.assign(country_region=countries.cat.reorder_categories(
+            sorted(countries.cat.categories)))
+        
+        self.source_data=self.data
+        self.source_stringency=self.stringency
+        self.date_codes=None
         
     def get_dates(self):
         
-        first_date=second_datetime.strptime(self.data.date.unique().tolist()[0], "%Y-%m-%d").date()       
-        last_date=second_datetime.strptime(self.data.date.unique().tolist()[-1], "%Y-%m-%d").date()
+        first_date=second_datetime.strptime(self.source_data.date.unique().tolist()[0], "%Y-%m-%d").date()       
+        last_date=second_datetime.strptime(self.source_data.date.unique().tolist()[-1], "%Y-%m-%d").date()
         base_date=datetime.strptime(str(datetime.now().year - 10) + "/12/01",
                                       "%Y/%m/%d").date()
 
@@ -115,327 +971,807 @@ class DataPreProcessor:
         return date_form
         
     
-    def format_stringency(self,from_date,to_date,date_dict,dict_weeks):
+    @staticmethod
+    def stringency_name_column(columns):
         
-        column_names=[]
+        names=[column for column in columns if 'name' in str(column).lower()]
+        countries=[column for column in names if 'country' in str(column).lower()]
         
-        for column in self.stringency.columns:
-            
-            try:
-                date_form=self.format_date(column)
-                if date_form<from_date or date_form>to_date: 
-                    self.stringency.drop(columns=[column],inplace=True)                    
-                else:
-                    column_names.append(date_dict[date_form])
-
-            except:
-                if ('code').lower() in column:
-                    column='Code'
-                if ('name').lower() in column:
-                    column='Country'
-                column_names.append(column)
-                
-        self.stringency.columns=column_names
-        self.stringency.drop('Code',1,inplace=True)
-
-        self.stringency=self.stringency.T
+        return (countries or names)[0]
+    
+    @instrumented('format_stringency')
+    def format_stringency(self,from_date,to_date,date_dict=None,dict_weeks=None):
+        """
+        Turns the wide OxCGRT sheet (one row per country, one column per day) into
+        a day x country matrix restricted to the given period.
 
-        self.stringency.columns=self.stringency.iloc[0].tolist()
-        self.stringency=self.stringency[1:]
-        self.stringency=self.stringency.reset_index()
-        self.stringency=self.stringency.rename(columns = {'index':'week_year'})
-        self.stringency['week_year']=self.stringency['week_year'].astype(str)
-        self.stringency['2weeks']=self.stringency['week_year'].replace(self.dict_weeks)
+        All column headers are parsed in one pass and the in-range days, which must
+        also be covered by the mobility data (`date_dict`), are taken in one slice.
+        Missing values are set to 0. The 'week_year' and '2weeks' columns carry the
+        same categoricals as the mobility data, so their codes are the integer week
+        and bucket ids. Only national rows are kept when the sheet has a
+        jurisdiction column. Every call starts from the full sheet.
+        """
+        
+        date_dict=self.date_dict if date_dict is None else date_dict
+        week_ids={week:position for position,week in enumerate(self.weeks)}
+        
+        rows=self.source_stringency
+        jurisdiction=[column for column in rows.columns if 'jurisdiction' in str(column).lower()]
+        if jurisdiction:
+            rows=rows[rows[jurisdiction[0]]=='NAT_TOTAL']
+        
+        headers=self.parse_dates(np.asarray(rows.columns.astype(str),dtype=object))
+        selected=[(position,day.date()) for position,day in enumerate(headers)
+                  if not pd.isna(day) and from_date<=day.date()<=to_date 
+                  and day.date() in date_dict]
+        
+        positions=[position for position,_ in selected]
+        weeks=np.array([week_ids[date_dict[day]] for _,day in selected],dtype='int64')
+        
+        self.stringency=pd.DataFrame(rows.iloc[:,positions].to_numpy(dtype='float64').T,
+                                     columns=rows[self.stringency_name_column(rows.columns)].tolist())
         self.stringency=self.stringency.fillna(0)
+        self.stringency.insert(0,'week_year',pd.Categorical.from_codes(
+            weeks,categories=[str(week) for week in self.weeks]))
+        self.stringency['2weeks']=pd.Categorical.from_codes(weeks//2,categories=self.bucket_labels)
     
         return self.stringency
     
-    def format_main_data(self,from_date,to_date):
-        
-        self.data['date_trans'] = self.data['date'].apply(lambda x:
-                                                        self.format_date(x))
+    @staticmethod
+    def pair_weeks(week_year):
+        """
+        Pairs consecutive (week, year) tuples into 2-week buckets; an unpaired
+        trailing week forms a bucket on its own.
 
-        self.data = self.data[(self.data.date_trans>=from_date)&(self.data.date_trans<=to_date)]
+        Returns:
+            the bucket labels in order and a dictionary of str((week, year)) ->
+            bucket label covering the complete pairs
+        """
+        
+        bucket_labels=[]
+        dict_weeks={}
+        for position in range(0,len(week_year),2):
+            pair=tuple(week_year[position:position+2])
+            if len(pair)==2:
+                bucket_labels.append(str(pair))
+                dict_weeks[str(pair[0])]=str(pair)
+                dict_weeks[str(pair[1])]=str(pair)
+            else:
+                bucket_labels.append(str(pair[0]))
+                
+        return bucket_labels,dict_weeks
+    
+    @staticmethod
+    def parse_dates(values):
+        """
+        Parses an array of date strings in one pass, accepting the same two formats
+        as `format_date` ('%Y-%m-%d' and '%d%b%Y'). Returns a DatetimeIndex.
+        """
         
-        self.data['week'] = self.data['date_trans'].apply(lambda x:x.isocalendar().week)
-        self.data['weekday'] = self.data['date_trans'].apply(lambda x:x.isocalendar().weekday)
-        self.data['year'] = self.data['date_trans'].apply(lambda x:x.isocalendar().year)
-        self.data['week_year']=list(zip(self.data['week'],self.data['year']))
+        values=pd.Index(values)
+        parsed=pd.to_datetime(values,format="%Y-%m-%d",errors='coerce')
+        missing=parsed.isna()&values.notna()
         
-        self.date_dict=dict(zip(self.data['date_trans'],self.data['week_year']))
+        if missing.any():
+            parsed=parsed.where(~missing,pd.to_datetime(values,format="%d%b%Y",errors='coerce'))
+            
+        return pd.DatetimeIndex(parsed)
+    
+    def assign_weeks(self,dates):
+        """
+        Sets the ISO weeks ('weeks'), 2-week buckets ('bucket_labels', 'dict_weeks')
+        and the date -> (week, year) dictionary ('date_dict') of a period from its
+        dates, weeks being paired in the order the dates are given.
 
-        self.data.drop(columns=['date_trans'],inplace=True)
+        Returns:
+            the week id of every date and whether it is kept in the mobility rows
+            (Saturdays are not)
+        """
         
-        list_weeks=self.data['week_year'].unique().tolist()
-        list1=list_weeks[::2]
-        list2=list_weeks[1::2]
-        list_weeks1=list(zip(list1,list2))
+        iso=dates.isocalendar()
+        week_codes,week_keys=pd.factorize(iso['year'].to_numpy(dtype='int64')*100
+                                          +iso['week'].to_numpy(dtype='int64'))
+        self.weeks=[(int(key%100),int(key//100)) for key in week_keys]
+        self.bucket_labels,self.dict_weeks=self.pair_weeks(self.weeks)
+        self.date_dict={day.date():self.weeks[code] for day,code in zip(dates,week_codes)}
         
-        dict_weeks1={str(x[0]):str(x) for x in list_weeks1}
-        dict_weeks2={str(x[1]):str(x) for x in list_weeks1}
+        return week_codes,iso['day'].to_numpy()!=6
+    
+    @instrumented('format_main_data')
+    def format_main_data(self,from_date,to_date):
+        """
+        Restricts the mobility data to the given period and assigns the 2-week buckets.
 
-        self.dict_weeks=dict_weeks1|dict_weeks2
-        
-        self.data['week_year']=self.data['week_year'].apply(lambda x: str(x))
+        Dates are parsed and their ISO calendar fields derived once per unique date;
+        rows pick up their bucket through the date codes. The date codes are kept
+        between calls and every call starts from the full data set, so several
+        periods can be formatted from one DataPreProcessor. ISO weeks are paired in
+        order of appearance, an unpaired trailing week forms a bucket on its own,
+        and Saturdays are left out of the mobility rows. The '2weeks' and 'week_year'
+        columns are categoricals whose codes are the integer bucket and week ids.
 
-        self.data['2weeks']=self.data['week_year'].replace(self.dict_weeks)
+        Returns:
+            the formatted data, a dictionary of date -> (week, year) and a dictionary
+            of str((week, year)) -> 2-week bucket label
+        """
+        
+        if self.date_codes is None:
+            self.date_codes,unique_dates=pd.factorize(self.source_data['date'])
+            self.unique_dates=self.parse_dates(np.asarray(unique_dates,dtype=object))
+        date_codes,dates=self.date_codes,self.unique_dates
+        
+        in_range=np.asarray((dates>=pd.Timestamp(from_date))&(dates<=pd.Timestamp(to_date)))
+        week_codes,weekdays=self.assign_weeks(dates[in_range])
+        week_year,bucket_labels=self.weeks,self.bucket_labels
+        
+        # per unique date lookups, the trailing slot serves the missing dates (code -1)
+        week_lookup=np.full(len(dates)+1,-1,dtype='int64')
+        week_lookup[np.flatnonzero(in_range)]=week_codes
+        keep_lookup=np.append(in_range,False)
+        keep_lookup[np.flatnonzero(in_range)]=weekdays
         
-        self.data=self.data[self.data.weekday!=6]
-        self.data.drop(columns='weekday',inplace=True)
+        keep=keep_lookup[date_codes]
+        row_weeks=week_lookup[date_codes[keep]]
+        row_week_year=np.array(week_year,dtype='int64').reshape(-1,2)[row_weeks]
+        
+        self.data=self.source_data[keep].assign(
+            week=row_week_year[:,0].astype('int16'),
+            year=row_week_year[:,1].astype('int16'),
+            week_year=pd.Categorical.from_codes(row_weeks,
+                                                categories=[str(x) for x in week_year]),
+            **{'2weeks':pd.Categorical.from_codes(row_weeks//2,categories=bucket_labels)})
         
         return self.data, self.date_dict, self.dict_weeks
         
-    def group_data(self):
-        
-        self.data_gr=self.data[['country_region',
-               'retail_and_recreation_percent_change_from_baseline',
-               'grocery_and_pharmacy_percent_change_from_baseline',
-               'parks_percent_change_from_baseline',
-               'transit_stations_percent_change_from_baseline',
-               'workplaces_percent_change_from_baseline',
-               'residential_percent_change_from_baseline', '2weeks']]\
-            .groupby(['country_region','2weeks']).mean().reset_index()
-
-        self.data_gr.columns=['country', '2weeks',
-               'retail_and_recreation_percent_change_from_baseline',
-               'grocery_and_pharmacy_percent_change_from_baseline',
-               'parks_percent_change_from_baseline',
-               'transit_stations_percent_change_from_baseline',
-               'workplaces_percent_change_from_baseline',
-               'residential_percent_change_from_baseline']
-        
-        self.stringency_gr=self.stringency.groupby(['2weeks']).mean()
-        self.stringency_gr=self.stringency_gr.round()
-        
-        self.df_max1=self.stringency_gr.max().reset_index()
-        self.df_max1=self.df_max1.set_index('index') 
-        self.df_max2=self.stringency_gr.idxmax().reset_index()
-        self.df_max2=self.df_max2.set_index('index')
-        self.df_max=self.df_max2.merge(self.df_max1, on='index')
-        self.df_max.columns=['2weeks','stringency_value']
-        self.df_max['country']=self.stringency_gr.columns
-
-        
-        self.data_final=pd.merge(self.data_gr,self.df_max,on=['country','2weeks'])
-        self.data_final=self.data_final[['country', '2weeks', 'stringency_value','retail_and_recreation_percent_change_from_baseline',
-               'grocery_and_pharmacy_percent_change_from_baseline',
-               'parks_percent_change_from_baseline',
-               'transit_stations_percent_change_from_baseline',
-               'workplaces_percent_change_from_baseline',
-               'residential_percent_change_from_baseline']]
-
-        self.data_final=self.data_final.fillna(0)
+    def bucket_sums(self):
+        """
+        Returns the countries (an Index) and the mobility sums, non-missing counts and
+        row numbers per country x 2-week bucket of the formatted data.
+        """
+        
+        countries=self.data['country_region'].cat.categories
+        country_codes=self.data['country_region'].cat.codes.to_numpy().astype('int64')
+        bucket_codes=self.data['2weeks'].cat.codes.to_numpy().astype('int64')
+        keep=(country_codes>=0)&(bucket_codes>=0)
+        n_buckets=len(self.bucket_labels)
+        
+        sums,counts,rows=group_sums(country_codes[keep]*n_buckets+bucket_codes[keep],
+                                    self.data[MOBILITY_COLUMNS].to_numpy(dtype='float64')[keep],
+                                    len(countries)*n_buckets)
+        shape=(len(countries),n_buckets)
+        
+        return countries,sums.reshape(shape+(-1,)),counts.reshape(shape+(-1,)),rows.reshape(shape)
+    
+    def day_sums(self):
+        """
+        Returns the countries and days, both sorted, and the mobility sums, non-missing
+        counts and row numbers per country x day of the full data set.
+        """
+        
+        data=self.source_data
+        
+        country_codes,countries=pd.factorize(data['country_region'].astype(object),sort=True)
+        day_codes,days=pd.factorize(self.parse_dates(np.asarray(data['date'],dtype=object)),sort=True)
+        keep=(country_codes>=0)&(day_codes>=0)
+        
+        sums,counts,rows=group_sums(country_codes[keep]*len(days)+day_codes[keep],
+                                    data[MOBILITY_COLUMNS].to_numpy(dtype='float64')[keep],
+                                    len(countries)*len(days))
+        shape=(len(countries),len(days))
+        
+        return list(countries),pd.DatetimeIndex(days),sums.reshape(shape+(len(MOBILITY_COLUMNS),)),\
+            counts.reshape(shape+(len(MOBILITY_COLUMNS),)),rows.reshape(shape)
+    
+    @instrumented('group_data')
+    def group_data(self,reducer='peak'):
+        """
+        Joins the mobility means of every country with the summary of its stringency
+        over the 2-week buckets: by default the bucket of peak (rounded mean)
+        stringency and its value, otherwise the reducer given (see `reduce_buckets`).
+
+        Both sides are dense numpy matrices indexed by the integer codes of the
+        '2weeks' categorical: mobility sums and counts per country x bucket from
+        bincount, stringency means per OxCGRT row x bucket from one accumulation over
+        the days. OxCGRT rows are joined to the mobility countries by code. With
+        'peak' and 'last' the mobility means are those of the selected bucket and
+        countries without mobility rows in it are left out; with 'mean' and 'median'
+        they cover the whole period and '2weeks' is 'all'.
+        """
+        
+        labels=list(self.bucket_labels)
+        countries,sums,counts,rows=self.bucket_sums()
+        sums,counts,rows=with_total(sums),with_total(counts),with_total(rows)
+        
+        sheet=self.stringency.drop(columns=['week_year','2weeks'])
+        day_buckets=self.stringency['2weeks'].cat.codes.to_numpy()
+        stringency_sums=np.zeros((len(labels),sheet.shape[1]))
+        np.add.at(stringency_sums,day_buckets,sheet.to_numpy(dtype='float64'))
+        with np.errstate(invalid='ignore',divide='ignore'):
+            means=(stringency_sums/np.bincount(day_buckets,minlength=len(labels))[:,None]).T
+            
+        bucket,value=reduce_buckets(means,labels,reducer)
+        
+        row_countries=countries.get_indexer(sheet.columns)
+        selected=np.flatnonzero((row_countries>=0)&np.isfinite(value))
+        selected=selected[rows[row_countries[selected],bucket[selected]]>0]
+        selected=selected[np.argsort(row_countries[selected],kind='stable')]
+        country,bucket=row_countries[selected],bucket[selected]
+        
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mobility=sums[country,bucket]/counts[country,bucket]
+            
+        self.data_final=pd.DataFrame(np.nan_to_num(mobility,nan=0.0).astype('float32'),
+                                     columns=MOBILITY_COLUMNS)
+        self.data_final.insert(0,'country',countries[country].astype(str))
+        self.data_final.insert(1,'2weeks',pd.Categorical.from_codes(
+            np.where(bucket<0,len(labels),bucket),
+            categories=labels+(['all'] if (bucket<0).any() else [])))
+        self.data_final.insert(2,'stringency_value',value[selected].astype('uint8'))
         
         return self.data_final
     
     
-class DataWriter:
+class FeatureCube:
+    """
+    Dense country x day arrays holding everything `group_data` needs, so that the
+    grouped features of any period can be computed with numpy reductions instead
+    of formatting and grouping the data frames again.
+
+    Attributes:
+        countries (list): Country names (mobility naming), sorted.
+        days (DatetimeIndex): The dates of the mobility data, sorted.
+        sums (ndarray): Sums of each mobility column, shape (countries, days, 6).
+        counts (ndarray): Number of non-missing values summed in `sums`.
+        rows (ndarray): Number of mobility rows per country and day.
+        stringency (ndarray): OxCGRT stringency per country and day (missing values
+            set to 0 as in `format_stringency`); NaN where the country or the day
+            is not in the OxCGRT sheet.
+
+    The arrays can be saved as .npy files and loaded back memory-mapped, which lets
+    worker processes share them without pickling.
+
+    Note:
+    - Weeks are paired in chronological order, which is the order of appearance
+      used by `format_main_data` for the date-sorted Google file.
+    """
     
-    def __init__(self,*files):
+    arrays=('sums','counts','rows','stringency')
+    
+    def __init__(self,countries,days,sums,counts,rows,stringency):
         
-        self.files=(files)
+        self.countries=countries
+        self.days=days
+        self.sums=sums
+        self.counts=counts
+        self.rows=rows
+        self.stringency=stringency
         
-    def write_to_excel(self):
+    @classmethod
+    @instrumented('feature_cube')
+    def from_processor(cls,processor):
         
-        for file in self.files:           
+        countries,days,sums,counts,rows=processor.day_sums()
+        
+        return cls(countries,days,sums,counts.astype('int32'),rows.astype('int32'),
+                   cls.stringency_matrix(processor.source_stringency,countries,days))
     
-            self.xlsx_wrt = pd.ExcelWriter("mobility_"+second_datetime.now()\
-                                           .strftime("%Y_%m_%d_%H_%M")+".xlsx", engine="xlsxwriter")
+    @staticmethod
+    def stringency_matrix(sheet,countries,days):
+        """
+        Aligns the national rows of the wide OxCGRT sheet to the given countries and days.
+        """
+        
+        jurisdiction=[column for column in sheet.columns if 'jurisdiction' in str(column).lower()]
+        if jurisdiction:
+            sheet=sheet[sheet[jurisdiction[0]]=='NAT_TOTAL']
+            
+        headers=DataPreProcessor.parse_dates(np.asarray(sheet.columns.astype(str),dtype=object))
+        header_days=days.get_indexer(headers)
+        row_countries=pd.Index(countries).get_indexer(
+            sheet[DataPreProcessor.stringency_name_column(sheet.columns)])
+        
+        stringency=np.full((len(countries),len(days)),np.nan)
+        values=sheet.iloc[:,np.flatnonzero(header_days>=0)].to_numpy(dtype='float64')
+        stringency[np.ix_(row_countries[row_countries>=0],header_days[header_days>=0])]=\
+            np.nan_to_num(values[row_countries>=0],nan=0.0)
+        
+        return stringency
+    
+    def extend(self,other):
+        """
+        Returns a cube with the days of `other` appended; days of this cube from the
+        first day of `other` on are replaced. Countries are the union of both.
+        """
+        
+        if len(other.days)==0:
+            return self
+        
+        kept=int((self.days<other.days[0]).sum())
+        countries=sorted(set(self.countries)|set(other.countries))
+        days=self.days[:kept].append(other.days)
+        old=pd.Index(countries).get_indexer(self.countries)
+        new=pd.Index(countries).get_indexer(other.countries)
+        
+        arrays=[]
+        for name in self.arrays:
+            current,appended=getattr(self,name),getattr(other,name)
+            combined=np.full((len(countries),len(days))+current.shape[2:],
+                             np.nan if name=='stringency' else 0,dtype=current.dtype)
+            combined[old,:kept]=current[:,:kept]
+            combined[new,kept:]=appended
+            arrays.append(combined)
+            
+        return FeatureCube(countries,days,*arrays)
+    
+    def save(self,directory):
+        
+        os.makedirs(directory,exist_ok=True)
+        for name in self.arrays:
+            np.save(os.path.join(directory,name+'.npy'),getattr(self,name))
+        with open(os.path.join(directory,'index.json'),'w') as handle:
+            json.dump({'countries':self.countries,
+                       'days':[str(day.date()) for day in self.days]},handle)
+            
+    @classmethod
+    def load(cls,directory,mmap_mode='r'):
         
-            self.workbook  = self.xlsx_wrt.book
+        with open(os.path.join(directory,'index.json')) as handle:
+            index=json.load(handle)
+            
+        return cls(index['countries'],pd.DatetimeIndex(index['days']),
+                   *[np.load(os.path.join(directory,name+'.npy'),mmap_mode=mmap_mode)
+                     for name in cls.arrays])
+    
+    def window(self,from_date,to_date,reducer='peak'):
+        """
+        Computes the `group_data` output for the given period: for every country the
+        2-week bucket of peak (rounded mean) stringency, its value and the mobility
+        means of that bucket, Saturdays excluded from the mobility means. Other
+        stringency reducers are applied as in `group_data`.
+        """
+        
+        buckets=self.window_buckets(self.days,from_date,to_date)
+        if buckets is None:
+            return self.window_features(self.countries,[],None,None,None,None,reducer)
+        
+        low,high,bucket_labels,starts=buckets
+        weekdays=(self.days[low:high].dayofweek!=5).astype('float64')
+        
+        sums,counts,rows=[np.add.reduceat(array,starts,axis=1) for array in
+                          (self.sums[:,low:high]*weekdays[None,:,None],
+                           self.counts[:,low:high]*weekdays[None,:,None],
+                           self.rows[:,low:high]*weekdays[None,:])]
+        
+        stringency=self.stringency[:,low:high]
+        available=~np.isnan(stringency)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            means=np.add.reduceat(np.where(available,stringency,0),starts,axis=1)\
+                /np.add.reduceat(available,starts,axis=1)
+            
+        return self.window_features(self.countries,bucket_labels,sums,counts,rows,means,reducer)
+    
+    @staticmethod
+    def window_buckets(days,from_date,to_date):
+        """
+        Locates the period in the sorted days and splits it into 2-week buckets.
 
-            file.to_excel(self.xlsx_wrt, sheet_name="Country_groups", index=False)
+        Returns:
+            the first and past-the-end day positions, the bucket labels and the first
+            position of every bucket relative to the period start, or None if no day
+            falls in the period
+        """
+        
+        low=days.searchsorted(pd.Timestamp(from_date),side='left')
+        high=days.searchsorted(pd.Timestamp(to_date),side='right')
+        if low>=high:
+            return None
+        
+        iso=days[low:high].isocalendar()
+        week_codes,week_keys=pd.factorize(iso['year'].to_numpy(dtype='int64')*100
+                                          +iso['week'].to_numpy(dtype='int64'))
+        bucket_labels,_=DataPreProcessor.pair_weeks([(int(key%100),int(key//100))
+                                                     for key in week_keys])
+        buckets=week_codes//2
+        
+        return low,high,bucket_labels,np.flatnonzero(np.r_[True,buckets[1:]!=buckets[:-1]])
+    
+    @staticmethod
+    def window_features(countries,bucket_labels,sums,counts,rows,means,reducer='peak'):
+        """
+        Builds the `group_data` output from the mobility sums, counts and rows per
+        country x bucket (Saturdays excluded) and the stringency means per country x
+        bucket.
+        """
+        
+        columns=['country','2weeks','stringency_value']+MOBILITY_COLUMNS
+        if len(bucket_labels)==0:
+            return pd.DataFrame(columns=columns)
+        
+        sums,counts,rows=with_total(sums),with_total(counts),with_total(rows)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mobility=sums/counts
+            
+        bucket,value=reduce_buckets(means,bucket_labels,reducer)
+        positions=np.arange(len(countries))
+        
+        selected=np.isfinite(value)&(rows[positions,bucket]>0)
+        positions,bucket=positions[selected],bucket[selected]
+        
+        labels=bucket_labels+['all']
+        data_final={'country':[countries[position] for position in positions],
+                    '2weeks':[labels[code] for code in bucket],
+                    'stringency_value':value[selected].astype('uint8')}
+        data_final.update(zip(MOBILITY_COLUMNS,np.nan_to_num(mobility[positions,bucket],nan=0.0).T))
+        
+        return pd.DataFrame(data_final,columns=columns)
+    
+    
+class PrefixIndex:
+    """
+    Cumulative sums over the days of the FeatureCube arrays: the sums of any date
+    range, or of any 2-week bucket, are the difference of two lookups, so the
+    grouped features and means of a period cost countries x buckets operations
+    whatever its length, instead of a pass over its days.
 
-            self.xlsx_wrt.save()
-            self.workbook.close()
+    Mobility sums, counts and rows are accumulated over the days other than
+    Saturdays, which `group_data` leaves out; stringency is accumulated over all
+    days with its number of days with values. Every array starts with a zero column,
+    so position i holds the totals of the days before day i. Mobility percent changes
+    are integers, so their float64 totals are exact; counts are int32.
 
+    Attributes:
+        countries (list): Country names (mobility naming), sorted.
+        days (DatetimeIndex): The dates of the mobility data, sorted.
+        sums, counts (ndarray): Cumulative mobility sums and non-missing counts,
+            shape (countries, days + 1, 6).
+        rows (ndarray): Cumulative number of mobility rows, shape (countries, days + 1).
+        stringency (ndarray): Cumulative stringency (missing values as 0).
+        stringency_days (ndarray): Cumulative number of days with stringency.
 
-def menu(choices=list(''), title='', nr_rows=30):
-        """A function to create a user menu from a list as input
-        Input:  choices - a list of user selectable items
-                title - the menu title
-                nr_rows - is the maximum number of row to be visible
-                            on the screen without a mouse scroll
-        Output: a_chosen - a value selected by the user from the list of choices
-        """
+    Like FeatureCube, the index can be saved and loaded back memory-mapped and used
+    by clustering.ClusteringEngine; `cached` keeps it in a FileCache directory.
+
+    Example:
+    ```
+    index = PrefixIndex.cached('Global_Mobility_Report.csv', 'OxCGRT_timeseries_all.xlsx', '.mobility_cache')
+    data_final = index.window(from_date, to_date)
+    ```
+    """
     
-        def user_selection():
-            move_text = listbox.selection_get()
-            curindex = int(listbox.curselection()[0])
-            listbox.delete(curindex)
-            a_chosen.append(move_text)
-            master.quit()
+    arrays=('sums','counts','rows','stringency','stringency_days')
     
-        def quit_app():
-            if messagebox.askokcancel("Quit", "Do you want to quit?"):
-                print("Exiting the program")
-                sys.exit(-1)
+    def __init__(self,countries,days,sums,counts,rows,stringency,stringency_days):
+        
+        self.countries=countries
+        self.days=days
+        self.sums=sums
+        self.counts=counts
+        self.rows=rows
+        self.stringency=stringency
+        self.stringency_days=stringency_days
+        
+    @staticmethod
+    def accumulate(array,dtype):
+        
+        totals=np.zeros((array.shape[0],array.shape[1]+1)+array.shape[2:],dtype=dtype)
+        np.cumsum(array,axis=1,dtype=dtype,out=totals[:,1:])
+        
+        return totals
     
-        master = tk.Tk(screenName=title, baseName=title)
-        avl_choices = len(choices)
-        wdt = len((max(choices, key=len)))
-        master.geometry('300' + 'x' + str(int(min(min(nr_rows, avl_choices) * 16 + 40, 700))))
-        master.title(title)
-        master.protocol('WM_DELETE_WINDOW', quit_app)
+    @classmethod
+    @instrumented('prefix_index')
+    def from_cube(cls,cube):
+        
+        weekdays=(cube.days.dayofweek!=5)
+        available=~np.isnan(cube.stringency)
+        
+        return cls(list(cube.countries),cube.days,
+                   cls.accumulate(np.where(weekdays[None,:,None],cube.sums,0),'float64'),
+                   cls.accumulate(np.where(weekdays[None,:,None],cube.counts,0),'int32'),
+                   cls.accumulate(np.where(weekdays[None,:],cube.rows,0),'int32'),
+                   cls.accumulate(np.where(available,cube.stringency,0),'float64'),
+                   cls.accumulate(available,'int32'))
     
-        frame = tk.Frame(master)
-        frame.pack()
+    @classmethod
+    def cached(cls,mobility_file,stringency_file,cache_dir,indicator=None):
+        """
+        Loads the country level index of the given files from `cache_dir`, or builds
+        and stores it there. The entry is dropped when the mobility file changes and
+        not found again when the OxCGRT file does.
+        """
+        
+        # one cache instance, so that the parsed frames registered by the reader are
+        # kept in the manifest along with the index
+        reader=DataReader(mobility_file,stringency_file,streaming=True,level='country',
+                          cache_dir=cache_dir,indicators=[indicator] if indicator else None)
+        cache=reader.cache
+        key=cache.key(mobility_file,kind='prefix_index',stringency=cache.fingerprint(stringency_file),
+                      indicator=indicator)
+        directory=cache.path(key,'.index')
+        
+        if os.path.exists(os.path.join(directory,'index.json')):
+            return cls.load(directory)
+        
+        data,stringency=reader.read()
+        index=cls.from_cube(FeatureCube.from_processor(DataPreProcessor(data,stringency)))
+        index.save(directory)
+        cache.register(key,mobility_file)
+        
+        return index
     
-        listbox = tk.Listbox(frame, width=int(wdt * 1.5),
-                             height=int(min(nr_rows, avl_choices)), font=('times', 10))
-        listbox.place(x=52, y=90)
-        listbox.pack(side="left", fill="y")
+    def with_stringency(self,sheet):
+        """Returns an index sharing the mobility totals with the stringency of another OxCGRT sheet."""
+        
+        stringency=FeatureCube.stringency_matrix(sheet,self.countries,self.days)
+        available=~np.isnan(stringency)
+        
+        return PrefixIndex(self.countries,self.days,self.sums,self.counts,self.rows,
+                           self.accumulate(np.where(available,stringency,0),'float64'),
+                           self.accumulate(available,'int32'))
     
-        if avl_choices > 2:
-            scrollbar = tk.Scrollbar(frame, orient="vertical")
-            scrollbar.config(command=listbox.yview)
-            scrollbar.pack(side="right", fill="y")
-            listbox.config(yscrollcommand=scrollbar.set)
+    def save(self,directory):
+        
+        os.makedirs(directory,exist_ok=True)
+        for name in self.arrays:
+            np.save(os.path.join(directory,name+'.npy'),getattr(self,name))
+        with open(os.path.join(directory,'index.json'),'w') as handle:
+            json.dump({'countries':self.countries,
+                       'days':[str(day.date()) for day in self.days]},handle)
+            
+    @classmethod
+    def load(cls,directory,mmap_mode='r'):
+        
+        with open(os.path.join(directory,'index.json')) as handle:
+            index=json.load(handle)
+            
+        return cls(index['countries'],pd.DatetimeIndex(index['days']),
+                   *[np.load(os.path.join(directory,name+'.npy'),mmap_mode=mmap_mode)
+                     for name in cls.arrays])
     
-        a_chosen = list('')
+    def totals(self,begin,end):
+        """Returns the totals of every array between the day positions `begin` and `end`."""
+        
+        return [np.asarray(getattr(self,name)[:,end])-np.asarray(getattr(self,name)[:,begin])
+                for name in self.arrays]
     
-        moveBtn = tk.Button(master, text="OK", command=user_selection)
-        moveBtn.pack()
+    def bucket_totals(self,from_date,to_date):
+        """
+        Splits the period into 2-week buckets as `group_data` does.
+
+        Returns:
+            the bucket labels, the first and past-the-end day positions of every
+            bucket, the mobility sums, counts and rows per country x bucket and the
+            stringency means per country x bucket (NaN without values)
+        """
+        
+        buckets=FeatureCube.window_buckets(self.days,from_date,to_date)
+        if buckets is None:
+            return [],np.zeros(0,dtype='int64'),np.zeros(0,dtype='int64'),None,None,None,None
+        
+        low,high,bucket_labels,starts=buckets
+        begin=low+starts
+        end=np.append(begin[1:],high)
+        sums,counts,rows,stringency,stringency_days=self.totals(begin,end)
+        
+        with np.errstate(invalid='ignore',divide='ignore'):
+            means=stringency/stringency_days
+            
+        return bucket_labels,begin,end,sums,counts,rows,means
     
-        for item in choices:
-            listbox.insert(tk.END, item)
+    def window(self,from_date,to_date,reducer='peak'):
+        """Computes the same grouped features as `FeatureCube.window` from two lookups per bucket."""
+        
+        bucket_labels,begin,end,sums,counts,rows,means=self.bucket_totals(from_date,to_date)
+            
+        return FeatureCube.window_features(self.countries,bucket_labels,sums,counts,rows,means,reducer)
     
-        master.mainloop()
-        master.destroy()
-        return a_chosen
     
-class DateSelect:
-    def __init__(self,root):        
-   
-        self.top = tk.Toplevel(root)
-        now = datetime.now()
-        
-        self.cal = Calendar(self.top, font="Arial 12", selectmode='day',
-                            year=now.year, month=now.month, day=now.day,
-                            locale='en_US')
-                            
-        self.cal.pack(fill="both", expand=True)
-        ttk.Button(self.top, text="OK", command=self.print_sel).pack()
+class DataWriter:
+    """
+    Writes the result frames as Excel workbooks or as Parquet, Arrow IPC or CSV files.
 
-        self.date = datetime.strptime(str(datetime.now().year - 10) + "/12/01",
-                                      "%Y/%m/%d").date()
-        self.top.grab_set()
-
-    def print_sel(self):
-        self.date = self.cal.selection_get()
-        self.top.destroy()
-
-
-class PeriodExtract:
-    def __init__(self, from_date, to_date):
-        self.root = tk.Tk()
-        s = ttk.Style(self.root)
-        s.theme_use('clam')
-
-        label = ttk.Label(self.root, text="Please select From and To Dates:",
-                          font=("Verdana", 10))
-        label.pack(side="top", fill="x", pady=0)
-        ttk.Button(self.root, text='Select: FROM Date',
-                   command=self.fdate).pack(padx=10, pady=10)
-        ttk.Button(self.root, text='Select:  TO  Date',
-                   command=self.tdate).pack(padx=10, pady=10)
-
-        self.frdate = from_date
-        self.todate = to_date
-
-        self.root.mainloop()
-
-    def tdate(self):
-        cal = DateSelect(self.root)
-        self.root.wait_window(cal.top)
-        self.frdate = cal.date
-        
-        if self.frdate == datetime.strptime(str(datetime.now().year - 10) + "/12/01",
-                        "%Y/%m/%d").date() or self.todate == datetime.strptime(
-                       str(datetime.now().year - 3) + "/12/01", "%Y/%m/%d").date():
-                                
-            if self.frdate == datetime.strptime(str(datetime.now().year - 10) 
-                                                + "/12/01", "%Y/%m/%d").date():
-                
-                if self.todate == datetime.strptime(str(datetime.now().year - 10) 
-                                                    + "/12/01", "%Y/%m/%d").date():
-                    
-                    label = ttk.Label(self.root, 
-                                      text="'From Date': ____-__-__  --  'To  Date': ____-__-__",
-                                      font=("Verdana", 10), foreground='#ff0000')
-                else:
-                    label = ttk.Label(self.root,
-                                      text="'From Date': " + str(self.todate)
-                                      +" --  'To  Date': ____-__-__",
-                                      font=("Verdana", 10), foreground='#ff0000')
-            else:
-                label = ttk.Label(self.root, 
-                                  text="'From Date': ____-__-__ --  'To  Date': "
-                                  + str(self.frdate),
-                                  font=("Verdana", 10), foreground='#ff0000')
-        else:
-            if self.frdate <= self.todate:
-                x = self.frdate
-                self.frdate = self.todate
-                self.todate = x
-            label = ttk.Label(self.root,
-                              text="'From Date': " + str(self.todate) 
-                              + " --  'To  Date': " + str(self.frdate),
-                              font=("Verdana", 10))
-        label.pack(side='top', fill="x", padx=0, pady=0)
-
-    def fdate(self):
-        cal = DateSelect(self.root)
-        self.root.wait_window(cal.top)
-        self.todate = cal.date
-        if self.frdate == datetime.strptime(str(datetime.now().year - 10) + "/12/01",
-                            "%Y/%m/%d").date() or self.todate == datetime.strptime(
-                        str(datetime.now().year - 3) + "/12/01", "%Y/%m/%d").date():
-                                    
-            if self.frdate == datetime.strptime(str(datetime.now().year - 10)
-                                                + "/12/01", "%Y/%m/%d").date():
-                
-                if self.todate == datetime.strptime(str(datetime.now().year - 10) 
-                                                    + "/12/01", "%Y/%m/%d").date():
-                    
-                    label = ttk.Label(self.root, 
-                                      text="'From Date': ____-__-__  --  'To  Date': ____-__-__",
-                                      font=("Verdana", 10), foreground='#ff0000')
-                else:
-                    label = ttk.Label(self.root,
-                                      text="'From Date': " + str(self.todate) 
-                                      + " --  'To  Date': ____-__-__",
-                                      font=("Verdana", 10), foreground='#ff0000')
-            else:
-                label = ttk.Label(self.root, 
-                                  text="'From Date': ____-__-__ --  'To  Date': "
-                                  + str(self.frdate),
-                                  font=("Verdana", 10), foreground='#ff0000')
-        else:
-            if self.frdate <= self.todate:
-                x = self.frdate
-                self.frdate = self.todate
-                self.todate = x
-            label = ttk.Label(self.root,
-                              text="'From Date': " + str(self.todate) 
-                              + " --  'To  Date': " + str(self.frdate),
-                              font=("Verdana", 10))
-        label.pack(side='top', fill="x", padx=0, pady=0)
+    Workbooks are streamed row by row with xlsxwriter's constant memory mode, so the
+    memory used does not grow with the size of the sheet. By default every frame
+    goes to its own '<prefix>_<name><extension>' file; with `single_file` all frames
+    are written in one pass into one artifact, as sheets of '<prefix>_<artifact>.xlsx'
+    or as '<name><extension>' partitions of the '<prefix>_<artifact>' directory.
+
+    Names are made safe for file and sheet names and unique (ignoring case) by
+    appending '_2', '_3', ... to repeated ones, so no frame overwrites another.
+    Sheet names longer than Excel's 31 characters are shortened (see sheet_name)
+    and a first 'sheets' sheet then gives the full name of every sheet.
+    Without `names` the frames are named by the current time to the second and
+    existing outputs of that name are not overwritten either.
+
+    Attributes:
+        files (tuple): The data frames to write.
+        output_dir (str): Directory of the outputs.
+        names (list): Name of every frame, the current time by default.
+        single_file (bool): If True, all frames are written into one artifact.
+        artifact (str): Name of that artifact, the current time by default.
+        prefix (str): Prefix of the output file names.
+
+    Example:
+    ```
+    writer = DataWriter(data_all, data_spring, names=['all', 'spring'], single_file=True)
+    writer.write('parquet')
+    ```
+    """
+    
+    def __init__(self,*files,output_dir='.',names=None,single_file=False,artifact=None,
+                 prefix='mobility'):
         
+        self.files=(files)
+        self.output_dir=output_dir
+        self.names=names
+        self.single_file=single_file
+        self.artifact=artifact
+        self.prefix=prefix
         
+    @staticmethod
+    def unique_names(names,limit=None,taken=()):
+        """
+        Replaces the characters not allowed in file or sheet names, cuts the names
+        to `limit` characters and numbers repeated ones (also those in `taken`).
+        """
         
+        taken=set(name.lower() for name in taken)
+        unique=[]
         
+        for name in names:
+            name=re.sub(r'[\\/:*?"<>|\[\]]','_',str(name)).strip() or 'data'
+            candidate,number=name[:limit],1
+            while candidate.lower() in taken:
+                number+=1
+                suffix='_'+str(number)
+                candidate=name[:limit-len(suffix) if limit else None]+suffix
+            taken.add(candidate.lower())
+            unique.append(candidate)
+            
+        return unique
+    
+    @staticmethod
+    def sheet_name(name,limit=31):
+        """
+        Shortens a name longer than `limit`: ISO dates become YYMMDD, the window
+        '<from>_<to>' becomes '<from>-<to>' and SHEET_ABBREVIATIONS are applied,
+        e.g. 'temporal_labels_2020-03-01_2020-04-30_k3' -> 'tl_200301-200430_k3'.
+        """
         
+        name=str(name)
+        if len(name)<=limit:
+            return name
         
+        name=re.sub(r'\d{2}(\d{2})-(\d{2})-(\d{2})',r'\1\2\3',name)
+        name=re.sub(r'(\d{6})_(\d{6})',r'\1-\2',name)
+        for word,abbreviation in SHEET_ABBREVIATIONS.items():
+            name=name.replace(word,abbreviation)
+            
+        return name
+    
+    def paths(self,fmt='xlsx'):
+        """
+        Returns the path of every frame's file, or with `single_file` the path of the
+        artifact and the sheet or partition name of every frame.
+        """
         
+        extension=OUTPUT_FORMATS[fmt]
+        stamp=second_datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
         
+        # outputs are a file per frame, a workbook or a directory of partitions
+        suffix='' if self.single_file and fmt!='xlsx' else extension
+        existing=[os.path.splitext(name)[0] for name in (os.listdir(self.output_dir)
+                  if os.path.isdir(self.output_dir) else []) if os.path.splitext(name)[1]==suffix]
         
+        if self.single_file:
+            
+            artifact=self.unique_names([self.prefix+'_'+(self.artifact or stamp)],
+                                       taken=[] if self.artifact else existing)[0]
+            names=self.names if self.names is not None else [stamp]*len(self.files)
+            
+            if fmt=='xlsx':
+                names=self.unique_names([self.sheet_name(name) for name in names],limit=31,
+                                        taken=['sheets'])
+            else:
+                names=self.unique_names(names)
+            
+            return os.path.join(self.output_dir,artifact+suffix),names
         
+        if self.names is not None:
+            names=self.unique_names([self.prefix+'_'+name for name in self.names])
+        else:
+            names=self.unique_names([self.prefix+'_'+stamp]*len(self.files),taken=existing)
         
+        return [os.path.join(self.output_dir,name+extension) for name in names]
+    
+    @instrumented('write',frames=lambda writer: writer.files)
+    def write(self,fmt='xlsx'):
+        """
+        Writes the frames in the given format (see OUTPUT_FORMATS).
+
+        Returns:
+            the paths written
+        """
         
+        os.makedirs(self.output_dir,exist_ok=True)
         
+        if not self.single_file:
+            
+            paths=self.paths(fmt)
+            for path,file in zip(paths,self.files):
+                if fmt=='xlsx':
+                    self.write_workbook(path,[("Country_groups",file)])
+                else:
+                    self.write_frame(path,file,fmt)
+                    
+            return paths
         
+        artifact,names=self.paths(fmt)
         
-
+        if fmt=='xlsx':
+            sheets=list(zip(names,self.files))
+            full_names=[str(name) for name in self.names or []]
+            if any(sheet!=name for sheet,name in zip(names,full_names)):
+                sheets.insert(0,('sheets',pd.DataFrame({'sheet':names,'name':full_names})))
+            self.write_workbook(artifact,sheets)
+            return [artifact]
+        
+        os.makedirs(artifact,exist_ok=True)
+        paths=[os.path.join(artifact,name+OUTPUT_FORMATS[fmt]) for name in names]
+        for path,file in zip(paths,self.files):
+            self.write_frame(path,file,fmt)
+            
+        return paths
     
+    def write_to_excel(self):
+        
+        return self.write('xlsx')
+    
+    @staticmethod
+    def write_frame(path,frame,fmt):
+        
+        frame=frame.reset_index(drop=True)
+        
+        if fmt=='parquet':
+            frame.to_parquet(path,index=False)
+        elif fmt=='arrow':
+            frame.to_feather(path)
+        else:
+            frame.to_csv(path,index=False)
+            
+    @staticmethod
+    def write_workbook(path,sheets):
+        """Streams the (sheet name, frame) pairs into one workbook in constant memory."""
+        
+        import xlsxwriter
+        
+        workbook=xlsxwriter.Workbook(path,{'constant_memory':True,
+                                           'default_date_format':'yyyy-mm-dd'})
+        header=workbook.add_format({'bold':True,'border':1,'align':'center'})
+        
+        for sheet_name,frame in sheets:
+            
+            worksheet=workbook.add_worksheet(sheet_name)
+            worksheet.write_row(0,0,[str(column) for column in frame.columns],header)
+            
+            # columns are converted to python values once; missing values are left blank
+            columns=[frame[column].astype(object).where(frame[column].notna(),None).tolist()
+                     for column in frame.columns]
+            for row,values in enumerate(zip(*columns),start=1):
+                worksheet.write_row(row,0,values)
+                
+        workbook.close()
+
+
+GUI_NAMES=('menu','DateSelect','PeriodExtract')
 
+
+def __getattr__(name):
+    """Loads the dialogs, moved to the gui module, on first access as utils attributes."""
+    
+    if name in GUI_NAMES:
+        import gui
+        return getattr(gui,name)
+    
+    raise AttributeError("module 'utils' has no attribute "+repr(name))